@@ -0,0 +1,177 @@
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent import futures
+from datetime import datetime
+
+import crypto
+
+# Encrypts or decrypts many files at once on a process pool, for the GUI's folder mode
+# and "cli.py encrypt/decrypt --batch". Each file is handled by a single worker
+# exactly like the one-file path (same output names, existing outputs are skipped),
+# and every run leaves a JSON manifest with one entry per file.
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_PREFIX = "crypt4gh_manifest"
+
+# Files submitted per worker ahead of time; bounds memory and makes cancel prompt
+QUEUE_DEPTH = 2
+
+# Set in each worker process by _init_worker
+_worker_action = None
+_worker_key = None
+_worker_cancel = None
+_worker_threads = 1
+
+
+def find_inputs(source, action):
+    # A directory is searched recursively (hidden directories such as the ID registry
+    # are skipped); anything else is taken as a glob pattern
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            paths.extend(os.path.join(root, name) for name in sorted(files) if not name.startswith("."))
+    else:
+        paths = sorted(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+    encrypted = [path.endswith(crypto.ENCRYPTED_EXTENSION) for path in paths]
+    if action == "Encrypt":
+        return [path for path, done in zip(paths, encrypted)
+                if not done and not os.path.basename(path).startswith(MANIFEST_PREFIX)]
+    return [path for path, done in zip(paths, encrypted) if done]
+
+
+def output_path(file_path, action):
+    if action == "Encrypt":
+        return crypto.encrypted_output_path(file_path)
+    return crypto.decrypted_output_path(file_path)
+
+
+def default_manifest_path(source, action):
+    # A name no other manifest has; runs started in the same second get "_2", "_3", ...
+    directory = source if os.path.isdir(source) else os.getcwd()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    name = f"{MANIFEST_PREFIX}_{action.lower()}_{timestamp}"
+    path = os.path.join(directory, f"{name}.json")
+    number = 1
+    while os.path.exists(path):
+        number += 1
+        path = os.path.join(directory, f"{name}_{number}.json")
+    return path
+
+
+def _init_worker(action, key, cancel, threads):
+    # Runs once per worker process: the parsed key arrives here once instead of with
+    # every file, and no worker ever re-reads the key file or re-runs its KDF
+    global _worker_action, _worker_key, _worker_cancel, _worker_threads
+    _worker_action, _worker_key, _worker_cancel, _worker_threads = action, key, cancel, threads
+
+
+def _check_cancel(_):
+    if _worker_cancel.is_set():
+        raise crypto.OperationCancelled()
+
+
+def _process_file(file_path):
+    return process_file(file_path, _worker_action, _worker_key, _check_cancel, _worker_threads)
+
+
+def process_file(file_path, action, key, progress=None, threads=None):
+    result = {"input": file_path, "output": output_path(file_path, action), "bytes": 0, "seconds": 0.0}
+    if os.path.exists(result["output"]):
+        result["status"] = "skipped"
+        result["error"] = "output already exists"
+        return result
+
+    started = time.perf_counter()
+    try:
+        result["bytes"] = os.path.getsize(file_path)
+        if action == "Encrypt":
+            crypto.encrypt_file(file_path, result["output"], key, progress, threads)
+        else:
+            crypto.decrypt_file(file_path, result["output"], key, progress)
+        result["status"] = "done"
+    except crypto.OperationCancelled:
+        _remove(result["output"])
+        result["status"] = "cancelled"
+    except Exception as e:
+        _remove(result["output"])
+        result["status"] = "failed"
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+def _remove(path):
+    if os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"Could not remove partial output {path}: {str(e)}")
+
+
+def run_batch(inputs, action, key, manifest_path, workers=None, progress=None, cancel_event=None):
+    # key is a list of public keys for "Encrypt" and a private key for "Decrypt".
+    # progress(result, finished, total) is called on this thread after every file;
+    # setting cancel_event stops queueing files and interrupts the ones in flight.
+    # manifest_path must not exist yet; it is created right away, so a concurrent run
+    # cannot pick the same name, and filled in at the end.
+    with open(manifest_path, 'x'):
+        pass
+    workers = max(1, min(workers or os.cpu_count() or 1, len(inputs) or 1))
+    threads = max(1, (os.cpu_count() or 1) // workers)  # Encryption threads per worker
+    cancel = multiprocessing.Event()
+    started = datetime.now()
+    results = {}
+    pending = {}
+    remaining = iter(inputs)
+
+    with futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(action, key, cancel, threads)) as executor:
+        def submit():
+            for file_path in remaining:
+                pending[executor.submit(_process_file, file_path)] = file_path
+                if len(pending) >= workers * QUEUE_DEPTH:
+                    break
+
+        submit()
+        while pending:
+            done, _ = futures.wait(pending, timeout=0.1, return_when=futures.FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set() and not cancel.is_set():
+                cancel.set()
+                for future in pending:
+                    future.cancel()
+            for future in done:
+                file_path = pending.pop(future)
+                if future.cancelled():
+                    continue
+                try:
+                    results[file_path] = future.result()
+                except Exception as e:  # The worker itself died
+                    results[file_path] = {"input": file_path, "output": output_path(file_path, action),
+                                          "status": "failed", "error": str(e), "bytes": 0, "seconds": 0.0}
+                if progress is not None:
+                    progress(results[file_path], len(results), len(inputs))
+            if not cancel.is_set():
+                submit()
+
+    files = [results.get(file_path) or {"input": file_path, "output": output_path(file_path, action),
+                                        "status": "cancelled", "bytes": 0, "seconds": 0.0}
+             for file_path in inputs]
+    summary = {status: sum(result["status"] == status for result in files)
+               for status in ("done", "skipped", "failed", "cancelled")}
+    manifest = {
+        "action": action.lower(),
+        "started": started.isoformat(timespec="seconds"),
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "workers": workers,
+        "summary": summary,
+        "files": files,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
@@ -0,0 +1,482 @@
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from model import (Model, PARALLEL_BLOCK, TARGET_IDS_PER_SECOND, WRITERS, XlsxIdWriter, BinaryIdReader, read_ids,
+                   validate_ids)
+
+
+def bench_generate(count=5_000_000):
+    model = Model()
+    model.set_seed("12345")
+    model.generate_ids(1000)  # Warm up
+
+    start = time.perf_counter()
+    ids = model.generate_ids(count)
+    elapsed = time.perf_counter() - start
+
+    rate = len(ids) / elapsed
+    print(f"generate_ids: {len(ids)} IDs in {elapsed:.3f}s ({rate:,.0f} IDs/s, target {TARGET_IDS_PER_SECOND:,} IDs/s)")
+
+    # Without the text conversion; this is what the GUI and the CLI generate
+    start = time.perf_counter()
+    packed = model.generate_packed(count)
+    elapsed = time.perf_counter() - start
+    print(f"generate_packed: {len(packed)} IDs in {elapsed:.3f}s ({len(packed) / elapsed:,.0f} IDs/s, "
+          f"{packed.nbytes / 2**20:,.1f} MiB)")
+    return rate >= TARGET_IDS_PER_SECOND
+
+
+def bench_generate_unique(count=5_000_000, batch_size=1_000_000):
+    model = Model()
+    model.set_seed("12345")
+    model.set_unique(True)
+
+    start = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        model.generate_packed(min(batch_size, count - offset))
+    elapsed = time.perf_counter() - start
+
+    rate = len(model.index) / elapsed
+    print(f"generate_ids (unique): {len(model.index)} IDs in {elapsed:.3f}s ({rate:,.0f} IDs/s)")
+    return len(model.index) == count
+
+
+def bench_parallel(count=5_000_000):
+    results = {}
+    for workers in sorted({1, os.cpu_count() or 1}):
+        model = Model()
+        model.set_seed("12345")
+        model.set_parallel(True, workers)
+        model.generate_ids(PARALLEL_BLOCK * workers)  # Start the pool
+        model.set_seed("12345")
+
+        start = time.perf_counter()
+        ids = model.generate_ids(count)
+        elapsed = time.perf_counter() - start
+        model.shutdown_workers()
+
+        results[workers] = ids
+        print(f"generate_ids (parallel, {workers} workers): {count} IDs in {elapsed:.3f}s ({count / elapsed:,.0f} IDs/s)")
+
+    # Same seed, same IDs whatever the worker count
+    first, *others = results.values()
+    return all(ids == first for ids in others)
+
+
+def _save_xlsx_in_memory(ids, path):
+    # The pre-streaming exporter: a regular workbook holding one cell object per ID
+    from openpyxl import Workbook
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Generated IDs"
+    ws.append(["ID"])
+    for id in ids:
+        ws.append([id])
+    wb.save(path)
+
+
+def _save_xlsx_write_only(ids, path):
+    writer = XlsxIdWriter(path)
+    writer.write(ids)
+    writer.close()
+
+
+def _run_xlsx_export(name, count, path):
+    # Runs in a fresh process so the peak RSS belongs to this exporter alone
+    model = Model()
+    model.set_seed("12345")
+    ids = model.generate_ids(count)
+    save = _save_xlsx_write_only if name == "write-only" else _save_xlsx_in_memory
+
+    start = time.perf_counter()
+    save(ids, path)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS and in KiB elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    return elapsed, peak
+
+
+def bench_xlsx(count=1_100_000):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("in-memory", "write-only"):
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                path = os.path.join(tmp, f"{name}.xlsx")
+                elapsed, peak = pool.submit(_run_xlsx_export, name, count, path).result()
+            results[name] = (elapsed, peak)
+            memory = f", peak RSS {peak / 2**20:,.1f} MiB" if peak is not None else ""
+            print(f"xlsx {name}: {count} rows in {elapsed:.3f}s{memory}")
+
+    (new_time, new_peak), (old_time, old_peak) = results["write-only"], results["in-memory"]
+    return new_time < old_time and (new_peak is None or new_peak < old_peak)
+
+
+def _read_csv(path):
+    import pandas
+    return pandas.read_csv(path)["ehealth_id"].to_numpy()
+
+
+def _read_parquet(path):
+    import pyarrow.parquet
+    return pyarrow.parquet.read_table(path).column("ehealth_id")
+
+
+def _read_ehid(path):
+    # Packed IDs into memory; reader[n] alone would not even touch the rest
+    return BinaryIdReader(path).packed.copy()
+
+
+def bench_read(count=10_000_000):
+    # How fast a downstream job loads an exported file again
+    readers = {".csv": _read_csv, ".parquet": _read_parquet, ".ehid": _read_ehid}
+    model = Model()
+    model.set_seed("12345")
+    packed = model.generate_packed(count)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for file_type, read in readers.items():
+            writer = WRITERS[file_type](os.path.join(tmp, f"ids{file_type}"))
+            writer.write(packed)
+            path = writer.close()
+
+            start = time.perf_counter()
+            loaded = read(path)
+            results[file_type] = time.perf_counter() - start
+            print(f"read {file_type}: {len(loaded)} IDs in {results[file_type]:.3f}s "
+                  f"({os.path.getsize(path) / 2**20:,.1f} MiB)")
+    return results[".ehid"] < results[".parquet"] < results[".csv"]
+
+
+def bench_validate(count=5_000_000):
+    # IDs/s of validate_ids on IDs with check characters, in memory and including
+    # reading each file format back; one corrupted ID per file must be found
+    model = Model()
+    model.set_seed("12345")
+    model.set_check_character(True)
+    ids = model.generate_ids(count)
+    ids[count // 2] = ids[count // 2][::-1]  # A typo the check character must catch
+
+    start = time.perf_counter()
+    bad = validate_ids(ids)
+    elapsed = time.perf_counter() - start
+    print(f"validate_ids: {count} IDs in {elapsed:.3f}s ({count / elapsed:,.0f} IDs/s)")
+    ok = bad.tolist() == [count // 2]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for file_type in (".txt", ".csv", ".json", ".parquet"):
+            path = os.path.join(tmp, f"ids{file_type}")
+            if file_type == ".parquet":
+                # ParquetIdWriter would refuse the corrupted ID
+                import pyarrow
+                import pyarrow.parquet
+                pyarrow.parquet.write_table(pyarrow.table({"ehealth_id": ids}), path)
+            else:
+                writer = WRITERS[file_type](path, check=True)
+                writer.write(ids)
+                writer.close()
+            start = time.perf_counter()
+            bad = validate_ids(read_ids(path))
+            elapsed = time.perf_counter() - start
+            print(f"validate {file_type}: {count} IDs in {elapsed:.3f}s ({count / elapsed:,.0f} IDs/s)")
+            ok = ok and bad.tolist() == [count // 2]
+    return ok
+
+
+def bench_shards(count=10_000_000, shard_size=1_000_000):
+    # IDs/s of a sharded export to gzip-compressed .txt against writing one
+    # compressed file on this thread; every shard must pass its manifest check and
+    # the shards together must hold count distinct IDs
+    import numpy as np
+    import shards
+    from model import COMPRESSION_SUFFIXES
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        model = Model()
+        model.set_seed("12345")
+        model.set_unique(True)
+        start = time.perf_counter()
+        writer = model.open_writer(tmp, ".txt", compression="gzip")
+        for offset in range(0, count, shard_size):
+            writer.write(model.generate_packed(min(shard_size, count - offset)))
+        writer.close()
+        elapsed = time.perf_counter() - start
+        print(f"one .txt{COMPRESSION_SUFFIXES['gzip']} file: {count} IDs in {elapsed:.3f}s "
+              f"({count / elapsed:,.0f} IDs/s)")
+
+        model = Model()
+        model.set_seed("12345")
+        model.set_unique(True)
+        start = time.perf_counter()
+        manifest_path, manifest = shards.export_shards(model, tmp, ".txt", count, shard_size, "gzip")
+        elapsed = time.perf_counter() - start
+        print(f"{len(manifest['shards'])} shards on {os.cpu_count()} CPUs: {count} IDs in {elapsed:.3f}s "
+              f"({count / elapsed:,.0f} IDs/s)")
+        ok = manifest["complete"] and not shards.verify_manifest(manifest_path)
+        directory = os.path.dirname(manifest_path)
+        ids = np.concatenate([np.asarray(read_ids(os.path.join(directory, shard["file"])))
+                              for shard in manifest["shards"]])
+        ok = ok and len(ids) == count and len(np.unique(ids)) == count
+    return ok
+
+
+def bench_encrypt(count=256):
+    # MB/s of the segment-parallel engine against crypt4gh's own encrypt, on a file of
+    # count MiB; both outputs must decrypt with crypt4gh
+    import io
+    import crypto
+    from crypt4gh import lib
+    from cryptography.hazmat.primitives.asymmetric import x25519
+
+    private_key = x25519.X25519PrivateKey.generate()
+    public_key = private_key.public_key().public_bytes_raw()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data.bin")
+        with open(path, 'wb') as f:
+            for _ in range(count):
+                f.write(os.urandom(2**20))
+
+        def reference(output):
+            with open(path, 'rb') as f_in, open(output, 'wb') as f_out:
+                crypto.encrypt_stream([public_key], f_in, f_out)
+
+        for name, encrypt in (("crypt4gh.lib", reference),
+                              ("engine", lambda output: crypto.encrypt_file(path, output, [public_key]))):
+            output = os.path.join(tmp, f"{name}.c4gh")
+            start = time.perf_counter()
+            encrypt(output)
+            elapsed = time.perf_counter() - start
+            results[name] = count / elapsed
+
+            decrypted = io.BytesIO()
+            with open(output, 'rb') as f:
+                lib.decrypt([(0, private_key.private_bytes_raw(), None)], f, decrypted)
+            with open(path, 'rb') as f:
+                identical = decrypted.getvalue() == f.read()
+            print(f"encrypt {name}: {count} MiB in {elapsed:.3f}s ({results[name]:,.0f} MiB/s)"
+                  + ("" if identical else ", ROUND TRIP FAILED"))
+            if not identical:
+                return False
+    return results["engine"] >= results["crypt4gh.lib"]
+
+
+def bench_pseudonymize(count=1_000_000):
+    # Rows/s of a CSV and a Parquet dataset with two identifier columns drawn from
+    # count / 4 patients: first against an empty mapping table, then again with every
+    # identifier already known. Both runs must give the same pseudonyms.
+    import numpy as np
+    import pandas
+    from pseudonymize import pseudonymize_file
+
+    rng = np.random.default_rng(12345)
+    patients = np.char.add("P", np.arange(max(1, count // 4)).astype(str)).astype(object)
+    dataset = pandas.DataFrame({
+        "patient_id": patients[rng.integers(0, len(patients), count)],
+        "mother_id": patients[rng.integers(0, len(patients), count)],
+        "value": rng.random(count),
+    })
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for file_type, save, load in ((".csv", dataset.to_csv, pandas.read_csv),
+                                      (".parquet", dataset.to_parquet, pandas.read_parquet)):
+            mapping = os.path.join(tmp, f"mapping{file_type}.sqlite")
+            outputs = []
+            path = os.path.join(tmp, f"dataset{file_type}")
+            save(path, index=False)
+            for run in ("new", "known"):
+                output = os.path.join(tmp, f"{run}{file_type}")
+                start = time.perf_counter()
+                rows, created = pseudonymize_file(path, output, ["patient_id", "mother_id"], mapping)
+                elapsed = time.perf_counter() - start
+                print(f"pseudonymize {file_type} ({run} identifiers): {rows} rows in {elapsed:.3f}s "
+                      f"({rows / elapsed:,.0f} rows/s, {created} new pseudonyms)")
+                outputs.append(load(output)[["patient_id", "mother_id"]].to_numpy())
+            ok = ok and (outputs[0] == outputs[1]).all()
+    return ok
+
+
+def bench_reidentify(count=1_000_000, lookups=100_000):
+    # Index build time, then bulk and one-at-a-time lookups in both directions
+    # against a mapping of count source identifiers
+    import numpy as np
+    from pseudonymize import PseudonymMap
+    from reidentify import build_index, ReidentificationIndex
+
+    sources = np.char.add("P", np.arange(count).astype(str)).astype(object)
+    with tempfile.TemporaryDirectory() as tmp:
+        mapping_path = os.path.join(tmp, "mapping.sqlite")
+        mapping = PseudonymMap(mapping_path)
+        ids = [mapping.map(sources[start:start + 250_000]) for start in range(0, count, 250_000)]
+        ids = np.concatenate(ids)
+        mapping.close()
+
+        start = time.perf_counter()
+        index = ReidentificationIndex(build_index(mapping_path))
+        print(f"reidentify build: {count} mappings in {time.perf_counter() - start:.3f}s")
+
+        sample = np.random.default_rng(12345).integers(0, count, min(lookups, count))
+        ok = True
+        for name, lookup, values, expected in (("id -> source", index.sources_for, ids, sources),
+                                               ("source -> id", index.pseudonyms_for, sources, ids)):
+            start = time.perf_counter()
+            results = lookup(values[sample].tolist())
+            bulk = time.perf_counter() - start
+            start = time.perf_counter()
+            for value in values[sample[:1000]].tolist():
+                lookup([value])
+            single = (time.perf_counter() - start) / min(1000, len(sample))
+            print(f"reidentify {name}: {len(sample)} bulk in {bulk:.3f}s ({len(sample) / bulk:,.0f}/s), "
+                  f"single {single * 1e6:.0f} us")
+            ok = ok and results == expected[sample].tolist()
+        index.close()
+    return ok
+
+
+def _http_get(sock, path):
+    # One keep-alive request; returns the body
+    sock.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode("ascii"))
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += sock.recv(65536)
+    head, body = data.split(b"\r\n\r\n", 1)
+    length = int(next(line.split(b":")[1] for line in head.split(b"\r\n") if line.lower().startswith(b"content-length")))
+    while len(body) < length:
+        body += sock.recv(max(65536, length - len(body)))
+    return body
+
+
+def bench_service(count=100_000, requests=2000):
+    # Latency of single IDs from the pool and of leasing a block of count IDs, on one
+    # keep-alive connection; then a restart on the same registry must not repeat any
+    import asyncio
+    import json
+    import socket
+    import threading
+    import service
+
+    def run(registry):
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        address = []
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        task = asyncio.run_coroutine_threadsafe(
+            service.serve(registry, port=0, pool_size=count, ready=lambda a: (address.append(a), started.set())), loop)
+        started.wait()
+        host, port = address[0].rsplit("/", 1)[1].split(":")
+        return loop, thread, task, socket.create_connection((host, int(port)))
+
+    issued = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for run_number in range(2):
+            loop, thread, task, sock = run(tmp)
+            start = time.perf_counter()
+            for _ in range(requests):
+                issued.append(json.loads(_http_get(sock, "/id"))["id"])
+            single = (time.perf_counter() - start) / requests
+            start = time.perf_counter()
+            issued.extend(_http_get(sock, f"/ids?count={count}&format=txt").decode().split())
+            lease = time.perf_counter() - start
+            sock.close()
+            task.cancel()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            print(f"service run {run_number + 1}: single ID {single * 1e6:.0f} us per request, "
+                  f"{count} IDs leased in {lease:.3f}s ({count / lease:,.0f} IDs/s)")
+    unique = len(set(issued)) == len(issued) == 2 * (requests + count)
+    print(f"service: {len(issued)} IDs issued over two runs, " + ("all unique" if unique else "REPEATS FOUND"))
+    return unique
+
+
+# Cold-start budgets for the entry modules, in milliseconds of cumulative import time
+STARTUP_BUDGET_MS = {
+    "cli": 100,
+    "controller": 500,  # Includes wxPython
+}
+
+# Must stay unloaded until a mode actually needs them
+HEAVY_MODULES = ("numpy", "openpyxl", "pyarrow", "pandas", "crypt4gh.lib", "crypt4gh.keys")
+
+
+def _cold_import(module):
+    # One fresh interpreter per sample, timed by "python -X importtime"
+    code = (
+        "import sys, types\n"
+        f"import {module}\n"
+        f"print(','.join(name for name in {HEAVY_MODULES!r} if type(sys.modules.get(name)) is types.ModuleType))"
+    )
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000, [name for name in result.stdout.strip().split(",") if name]
+    raise RuntimeError(f"no import time reported for {module}")
+
+
+def bench_startup(count=5):
+    ok = True
+    for module, budget in STARTUP_BUDGET_MS.items():
+        if module == "controller" and importlib.util.find_spec("wx") is None:
+            print("startup controller: skipped, wxPython is not installed")
+            continue
+        samples = [_cold_import(module) for _ in range(count)]
+        best = min(elapsed for elapsed, _ in samples)
+        loaded = sorted({name for _, names in samples for name in names})
+        print(f"startup {module}: {best:.1f} ms (budget {budget} ms)"
+              + (f", eagerly loaded: {', '.join(loaded)}" if loaded else ""))
+        ok = ok and best <= budget and not loaded
+    return ok
+
+
+BENCHMARKS = {
+    "generate": bench_generate,
+    "unique": bench_generate_unique,
+    "parallel": bench_parallel,
+    "xlsx": bench_xlsx,
+    "read": bench_read,
+    "encrypt": bench_encrypt,
+    "validate": bench_validate,
+    "shards": bench_shards,
+    "pseudonymize": bench_pseudonymize,
+    "reidentify": bench_reidentify,
+    "service": bench_service,
+    "startup": bench_startup,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Performance checks for the E-Health ID Generator.")
+    parser.add_argument("benchmarks", nargs="*", metavar="NAME",
+                        help=f"Benchmarks to run: {', '.join(sorted(BENCHMARKS))} (default: all)")
+    parser.add_argument("--count", type=int, help="Number of IDs per benchmark (default: per benchmark)")
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    ok = True
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        bench = BENCHMARKS[name]
+        ok = (bench(args.count) if args.count else bench()) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
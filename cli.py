@@ -0,0 +1,477 @@
+import argparse
+import getpass
+import importlib.util
+import os
+import sys
+
+import batch
+import crypto
+import pseudonymize
+import reidentify
+import shards
+from model import Model, COMPRESSION_SUFFIXES, GENERATION_CHUNK, WRITERS, SaveError, read_ids, validate_ids
+from registry import REGISTRY_DIRNAME
+
+# Headless entry point for cron jobs, containers and batch nodes. It shares Model and
+# crypto with the GUI but never imports wx. "-" means stdin/stdout, so every command
+# fits into a shell pipeline, e.g.
+#
+#   python cli.py generate -n 1000000 --seed 42 | python cli.py encrypt -k site.pub > ids.c4gh
+
+STDIO = "-"
+
+
+class CliError(Exception):
+    pass
+
+
+def passphrase_callback(args, prompt):
+    # Called by crypt4gh only when the key actually needs a passphrase
+    def callback():
+        if args.passphrase_env:
+            value = os.environ.get(args.passphrase_env)
+            if value is None:
+                raise CliError(f"environment variable {args.passphrase_env} is not set")
+            return value.encode()
+        if args.input == STDIO and not args.batch and not sys.stdin.isatty():
+            raise CliError("the key needs a passphrase; use --passphrase-env when piping data on stdin")
+        return getpass.getpass(prompt).encode() or None
+    return callback
+
+
+def open_input(path):
+    if path == STDIO:
+        return sys.stdin.buffer, False
+    if not os.path.isfile(path):
+        raise CliError(f"input file {path} does not exist")
+    return open(path, 'rb'), True
+
+
+def open_output(path, force):
+    if path == STDIO:
+        return sys.stdout.buffer, False
+    if os.path.exists(path) and not force:
+        raise CliError(f"output file {path} already exists (use --force to overwrite)")
+    return open(path, 'wb'), True
+
+
+def run_stream(args, default_output, process):
+    output = args.output or (default_output(args.input) if args.input != STDIO else STDIO)
+    f_in, close_in = open_input(args.input)
+    f_out, close_out = open_output(output, args.force)
+    try:
+        process(f_in, f_out)
+    except BaseException:
+        if close_out:
+            f_out.close()
+            os.remove(output)
+        raise
+    finally:
+        if close_in:
+            f_in.close()
+    if close_out:
+        f_out.close()
+    else:
+        f_out.flush()
+    return output
+
+
+def run_batch(args, action, key):
+    if args.output:
+        raise CliError("--output cannot be combined with --batch; outputs are written next to their inputs")
+    if args.force:
+        raise CliError("--force cannot be combined with --batch; existing outputs are always skipped")
+    inputs = batch.find_inputs(args.batch, action)
+    if not inputs:
+        raise CliError(f"no files to {action.lower()} in {args.batch}")
+    manifest_path = args.manifest or batch.default_manifest_path(args.batch, action)
+    if os.path.exists(manifest_path):
+        raise CliError(f"manifest {manifest_path} already exists")
+
+    def progress(result, finished, total):
+        if result["status"] == "failed":
+            print(f"{result['input']}: {result['error']}", file=sys.stderr)
+
+    summary = batch.run_batch(inputs, action, key, manifest_path, workers=args.jobs, progress=progress)["summary"]
+    print(manifest_path)
+    print(f"{summary['done']} {action.lower()}ed, {summary['skipped']} skipped, {summary['failed']} failed",
+          file=sys.stderr)
+    if summary["failed"]:
+        raise CliError(f"{summary['failed']} of {len(inputs)} files failed; see {manifest_path}")
+
+
+def cmd_generate(args):
+    model = Model()
+    model.set_unique(args.unique)
+    model.set_parallel(args.parallel or args.workers is not None, args.workers)
+    model.set_counter(args.counter)
+    model.set_check_character(args.check_character)
+    model.set_seed(args.seed)
+    if args.start and not args.counter:
+        raise CliError("--start needs --counter")
+    if args.counter and not args.seed:
+        raise CliError("--counter needs a --seed, otherwise positions cannot be reproduced")
+    use_registry = args.unique
+    file_type = f".{args.format}"
+    public_keys = None
+    if args.encrypt_for and not WRITERS[file_type].encryptable:
+        raise CliError(f"--encrypt-for cannot be used with --format {args.format}")
+    if args.compress and not WRITERS[file_type].compressible:
+        raise CliError(f"--compress cannot be used with --format {args.format}")
+    if args.compress == "zstd" and importlib.util.find_spec("zstandard") is None:
+        raise CliError("--compress zstd needs the 'zstandard' package")
+    if args.encrypt_for:
+        public_keys = [crypto.load_public_key(key_path) for key_path in args.encrypt_for]
+
+    if args.shard_size is not None:
+        return generate_shards(args, model, file_type, public_keys, use_registry)
+    if args.output == STDIO:
+        # Like "serve", a run on stdout records its IDs in ./.ehealth_registry
+        if use_registry:
+            model.open_registry(args.registry or os.path.join(os.getcwd(), REGISTRY_DIRNAME))
+        writer_class = WRITERS[file_type]
+        binary = writer_class.binary or public_keys or args.compress
+        writer = writer_class(stream=sys.stdout.buffer if binary else sys.stdout, public_keys=public_keys,
+                              check=args.check_character, compression=args.compress)
+    else:
+        if not os.path.isdir(args.output):
+            raise CliError(f"destination directory {args.output} does not exist")
+        if use_registry:
+            model.open_registry(args.registry or os.path.join(args.output, REGISTRY_DIRNAME))
+        writer = model.open_writer(args.output, file_type, public_keys, args.compress)
+
+    generated = 0
+    try:
+        while generated < args.count:
+            batch_count = min(GENERATION_CHUNK, args.count - generated)
+            writer.write(model.generate_packed(batch_count, args.start + generated))
+            generated += batch_count
+    except BaseException:
+        partial_path = writer.abort()
+        if partial_path:
+            print(f"{generated} IDs were saved to {partial_path}", file=sys.stderr)
+        raise
+    finally:
+        model.shutdown_workers()
+        model.close_registry()
+
+    output_path = writer.close()
+    if output_path:
+        print(output_path)
+
+
+def generate_shards(args, model, file_type, public_keys, use_registry):
+    if args.shard_size < 1:
+        raise CliError("--shard-size must be a positive number")
+    if args.output == STDIO or not os.path.isdir(args.output):
+        raise CliError("--shard-size needs an existing destination directory as --output")
+    if use_registry:
+        model.open_registry(args.registry or os.path.join(args.output, REGISTRY_DIRNAME))
+    try:
+        manifest_path, manifest = shards.export_shards(model, args.output, file_type, args.count, args.shard_size,
+                                                       args.compress, args.jobs, public_keys,
+                                                       start_counter=args.start)
+    except KeyboardInterrupt:
+        print("Interrupted; the finished shards are listed in the manifest", file=sys.stderr)
+        raise
+    finally:
+        model.shutdown_workers()
+        model.close_registry()
+    print(manifest_path)
+    print(f"{manifest['total']} IDs in {len(manifest['shards'])} shards", file=sys.stderr)
+
+
+def cmd_encrypt(args):
+    public_keys = [crypto.load_public_key(key_path) for key_path in args.recipient_key]
+    if args.batch:
+        return run_batch(args, "Encrypt", public_keys)
+    run_stream(args, crypto.encrypted_output_path,
+               lambda f_in, f_out: crypto.encrypt_stream(public_keys, f_in, f_out))
+
+
+def cmd_decrypt(args):
+    ranged = args.offset or args.length is not None
+    if ranged and (args.batch or args.input == STDIO):
+        raise CliError("--offset and --length need a single --input file, which must be seekable")
+    private_key = crypto.load_private_key(args.key, passphrase_callback(args, f"Passphrase for {args.key}: "))
+    if args.batch:
+        return run_batch(args, "Decrypt", private_key)
+    if ranged:
+        # Only the segments holding the range are decrypted; written to stdout by default
+        args.output = args.output or STDIO
+        run_stream(args, crypto.decrypted_output_path,
+                   lambda f_in, f_out: crypto.decrypt_range(private_key, f_in, f_out, args.offset, args.length))
+        return
+    run_stream(args, crypto.decrypted_output_path,
+               lambda f_in, f_out: crypto.decrypt_stream(private_key, f_in, f_out))
+
+
+def cmd_rekey(args):
+    private_key = crypto.load_private_key(args.key, passphrase_callback(args, f"Passphrase for {args.key}: "))
+    public_keys = [crypto.load_public_key(key_path) for key_path in args.recipient_key]
+    failed = 0
+    for file_path in args.files:
+        try:
+            in_place = crypto.rekey_file(file_path, private_key, public_keys, args.keep_other_recipients)
+        except (ValueError, OSError) as e:
+            print(f"{file_path}: {str(e)}", file=sys.stderr)
+            failed += 1
+            continue
+        print(file_path if in_place else f"{file_path} (header size changed, data copied)")
+    if failed:
+        raise CliError(f"{failed} of {len(args.files)} files could not be re-keyed")
+
+
+def cmd_pseudonymize(args):
+    if not os.path.isfile(args.input):
+        raise CliError(f"input file {args.input} does not exist")
+    output = args.output or pseudonymize.pseudonymized_output_path(args.input)
+    if os.path.exists(output) and not args.force:
+        raise CliError(f"output file {output} already exists (use --force to overwrite)")
+    rows, created = pseudonymize.pseudonymize_file(args.input, output, args.column, args.mapping,
+                                                   registry_path=args.registry)
+    print(output)
+    print(f"{rows} rows, {created} new pseudonyms", file=sys.stderr)
+
+
+def cmd_reidentify(args):
+    # Values come from the command line, or one per line from stdin for bulk lookups
+    values = args.values or [line.rstrip("\r\n") for line in sys.stdin]
+    index = reidentify.open_index(args.mapping, args.index, args.audit_log, args.reason)
+    with index:
+        results = index.pseudonyms_for(values) if args.from_source else index.sources_for(values)
+    for value, result in zip(values, results):
+        print(f"{value}\t{'' if result is None else result}")
+    missing = results.count(None)
+    if missing:
+        print(f"{missing} of {len(values)} not found", file=sys.stderr)
+
+
+def cmd_serve(args):
+    import asyncio
+    import service
+
+    def ready(address):
+        print(f"Serving eHealth IDs on {address}", file=sys.stderr)
+
+    try:
+        asyncio.run(service.serve(args.registry, args.host, args.port, args.unix_socket, args.pool, ready,
+                                  args.check_character))
+    except KeyboardInterrupt:
+        pass
+
+
+def cmd_validate(args):
+    # One "<file>:<row>: <value>" line per bad ID, rows counted from 1 = first ID
+    invalid = 0
+    for path in args.files:
+        if not os.path.isfile(path):
+            raise CliError(f"input file {path} does not exist")
+        ids = read_ids(path)
+        bad = validate_ids(ids, args.check_character)
+        for row in bad.tolist():
+            value = ids[row]
+            print(f"{path}:{row + 1}: {value.decode('ascii', 'replace') if isinstance(value, bytes) else value!s}")
+        print(f"{path}: {len(ids)} IDs, {len(bad)} invalid", file=sys.stderr)
+        invalid += len(bad)
+    if invalid:
+        raise CliError(f"{invalid} invalid IDs")
+
+
+def cmd_verify(args):
+    failed = 0
+    for manifest_path in args.manifests:
+        if not os.path.isfile(manifest_path):
+            raise CliError(f"manifest {manifest_path} does not exist")
+        problems = shards.verify_manifest(manifest_path)
+        for problem in problems:
+            print(problem)
+        print(f"{manifest_path}: {'OK' if not problems else f'{len(problems)} problems'}", file=sys.stderr)
+        failed += bool(problems)
+    if failed:
+        raise CliError(f"{failed} of {len(args.manifests)} exports failed verification")
+
+
+def cmd_keygen(args):
+    if not all(crypto.is_valid_key_name(key_name) for key_name in args.name):
+        raise CliError("key names must be non-empty and contain only alphanumeric characters or underscores")
+    if len(set(args.name)) != len(args.name):
+        raise CliError("each key name may only be given once")
+    if not os.path.isdir(args.output_dir) or not os.access(args.output_dir, os.W_OK):
+        raise CliError(f"output directory {args.output_dir} is invalid or not writable")
+    for key_name in args.name:
+        for key_path in crypto.key_pair_paths(args.output_dir, key_name):
+            if os.path.exists(key_path):
+                raise CliError(f"key {key_path} already exists")
+
+    if args.no_passphrase:
+        passphrase = None
+    elif args.passphrase_env:
+        passphrase = passphrase_callback(args, "")()
+    else:
+        passphrase = getpass.getpass("Passphrase for the private key (empty for none): ").encode() or None
+
+    failed = 0
+    for key_name, key_paths, error in crypto.generate_key_pairs(args.output_dir, args.name, passphrase, args.jobs):
+        if error:
+            print(f"{key_name}: {error}", file=sys.stderr)
+            failed += 1
+        else:
+            print("\n".join(key_paths))
+    if failed:
+        raise CliError(f"{failed} of {len(args.name)} key pairs could not be generated")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="ehealth-deid", description="E-Health ID Generator command line.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser("generate", help="Generate eHealth IDs")
+    generate.add_argument("-n", "--count", type=int, required=True, help="Number of IDs to generate")
+    generate.add_argument("--seed", default="", help="Seed for reproducible IDs")
+    generate.add_argument("-f", "--format", choices=[file_type[1:] for file_type in WRITERS], default="txt",
+                          help="Output format (default: txt)")
+    generate.add_argument("-o", "--output", default=STDIO,
+                          help="Destination directory, or - for stdout (default: -)")
+    generate.add_argument("--no-unique", dest="unique", action="store_false",
+                          help="Skip the uniqueness check and the ID registry")
+    generate.add_argument("--registry", help=f"ID registry directory (default: <output>/{REGISTRY_DIRNAME}, "
+                                             f"or ./{REGISTRY_DIRNAME} when writing to stdout)")
+    generate.add_argument("--parallel", action="store_true", help="Generate on all CPU cores")
+    generate.add_argument("--workers", type=int, help="Generate on this many worker processes")
+    generate.add_argument("--counter", action="store_true",
+                          help="Derive each ID from the seed and its position, so any range can be produced "
+                               "on its own (no registry needed)")
+    generate.add_argument("--start", type=int, default=0,
+                          help="Position of the first ID in counter mode (default: 0)")
+    generate.add_argument("--check-character", action="store_true",
+                          help="Append a check character to every ID (10 characters instead of 9)")
+    generate.add_argument("--encrypt-for", action="append", metavar="PUBLIC_KEY",
+                          help="Encrypt the output with Crypt4GH for this recipient while it is written, "
+                               "so no plaintext reaches disk (repeat for several recipients; not for xlsx)")
+    generate.add_argument("--compress", choices=list(COMPRESSION_SUFFIXES),
+                          help="Compress the output while it is written, before any encryption "
+                               "(zstd needs the zstandard package; not for parquet or xlsx)")
+    generate.add_argument("--shard-size", type=int, metavar="N",
+                          help="Split the output into files of N IDs written in parallel, in a new directory "
+                               f"under --output with a {shards.MANIFEST_NAME} of their row ranges and checksums")
+    generate.add_argument("-j", "--jobs", type=int,
+                          help="Worker processes writing shards (default: all CPU cores)")
+    generate.set_defaults(handler=cmd_generate)
+
+    encrypt = subparsers.add_parser("encrypt", help="Encrypt a file with Crypt4GH")
+    encrypt.add_argument("-k", "--recipient-key", action="append", required=True,
+                         help="Recipient public key (repeat for several recipients)")
+    decrypt = subparsers.add_parser("decrypt", help="Decrypt a Crypt4GH file")
+    decrypt.add_argument("-k", "--key", required=True, help="Private key")
+    decrypt.add_argument("--passphrase-env", help="Read the key passphrase from this environment variable")
+    decrypt.add_argument("--offset", type=int, default=0, help="Decrypt from this plaintext byte offset (default: 0)")
+    decrypt.add_argument("--length", type=int, help="Decrypt only this many bytes (default: to the end)")
+    for subparser, handler in ((encrypt, cmd_encrypt), (decrypt, cmd_decrypt)):
+        subparser.add_argument("-i", "--input", default=STDIO, help="Input file, or - for stdin (default: -)")
+        subparser.add_argument("-o", "--output",
+                               help="Output file, or - for stdout (default: next to the input, or stdout)")
+        subparser.add_argument("--force", action="store_true", help="Overwrite an existing output file")
+        subparser.add_argument("--batch", metavar="DIR_OR_GLOB",
+                               help="Process every file in a directory (recursively) or matching a glob pattern, "
+                                    "skipping existing outputs")
+        subparser.add_argument("-j", "--jobs", type=int, help="Worker processes for --batch (default: all CPU cores)")
+        subparser.add_argument("--manifest", help="Where --batch writes its JSON manifest (default: in the directory)")
+        subparser.set_defaults(handler=handler)
+
+    rekey = subparsers.add_parser("rekey", help="Replace the recipients of Crypt4GH files without re-encrypting "
+                                                "their data")
+    rekey.add_argument("files", nargs="+", metavar="FILE", help="Encrypted files, rewritten in place")
+    rekey.add_argument("-k", "--key", required=True, help="Private key of a current recipient")
+    rekey.add_argument("-r", "--recipient-key", action="append", required=True,
+                       help="New recipient public key (repeat for several recipients)")
+    rekey.add_argument("--keep-other-recipients", action="store_true",
+                       help="Keep the recipients that --key cannot see instead of removing them")
+    rekey.add_argument("--passphrase-env", help="Read the key passphrase from this environment variable")
+    rekey.set_defaults(handler=cmd_rekey, input=None, batch=None)
+
+    pseudonymize_parser = subparsers.add_parser("pseudonymize", help="Replace identifier columns of a CSV or "
+                                                                     "Parquet dataset with eHealth IDs")
+    pseudonymize_parser.add_argument("-i", "--input", required=True, help="Dataset (.csv or .parquet)")
+    pseudonymize_parser.add_argument("-c", "--column", action="append", required=True,
+                                     help="Identifier column to replace (repeat for several; all share one mapping)")
+    pseudonymize_parser.add_argument("-m", "--mapping", required=True,
+                                     help="Mapping table (SQLite), created if missing and reused across runs")
+    pseudonymize_parser.add_argument("-o", "--output", help="Output file (default: <input>_pseudonymized.<ext>)")
+    pseudonymize_parser.add_argument("--force", action="store_true", help="Overwrite an existing output file")
+    pseudonymize_parser.add_argument("--registry",
+                                     help=f"ID registry directory (default: <mapping directory>/{REGISTRY_DIRNAME})")
+    pseudonymize_parser.set_defaults(handler=cmd_pseudonymize)
+
+    reidentify_parser = subparsers.add_parser("reidentify", help="Look up the source identifiers of eHealth IDs "
+                                                                 "in a pseudonymize mapping table, or the reverse")
+    reidentify_parser.add_argument("values", nargs="*", metavar="VALUE",
+                                   help="eHealth IDs (or source identifiers with --from-source); "
+                                        "read one per line from stdin if none are given")
+    reidentify_parser.add_argument("-m", "--mapping", required=True, help="Mapping table written by pseudonymize")
+    reidentify_parser.add_argument("--from-source", action="store_true",
+                                   help="Look up the eHealth IDs of source identifiers instead")
+    reidentify_parser.add_argument("--index", help="Index directory, built or refreshed as needed "
+                                                   f"(default: <mapping>{reidentify.INDEX_SUFFIX})")
+    reidentify_parser.add_argument("--audit-log", help="Append every lookup to this JSON Lines file")
+    reidentify_parser.add_argument("--reason", help="Reason recorded with each lookup in the audit log")
+    reidentify_parser.set_defaults(handler=cmd_reidentify)
+
+    serve = subparsers.add_parser("serve", help="Issue fresh eHealth IDs to local clients over HTTP")
+    serve.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    serve.add_argument("--unix-socket", metavar="PATH", help="Listen on this Unix socket instead of TCP")
+    serve.add_argument("--registry", help=f"ID registry directory (default: ./{REGISTRY_DIRNAME})")
+    serve.add_argument("--pool", type=int, default=1_000_000, help="IDs kept ready in memory (default: 1000000)")
+    serve.add_argument("--check-character", action="store_true", help="Issue IDs with a check character")
+    serve.set_defaults(handler=cmd_serve)
+
+    validate = subparsers.add_parser("validate", help="Check the IDs in generated files for typos")
+    validate.add_argument("files", nargs="+", metavar="FILE",
+                          help=f"Files in any of the generate formats ({', '.join(WRITERS)})")
+    check = validate.add_mutually_exclusive_group()
+    check.add_argument("--check-character", dest="check_character", action="store_const", const=True,
+                       help="Every ID must carry a correct check character")
+    check.add_argument("--no-check-character", dest="check_character", action="store_const", const=False,
+                       help="No ID may carry a check character")
+    validate.set_defaults(handler=cmd_validate, check_character=None)
+
+    verify = subparsers.add_parser("verify", help="Check the shards of a sharded export against its manifest")
+    verify.add_argument("manifests", nargs="+", metavar="MANIFEST", help=f"{shards.MANIFEST_NAME} of an export")
+    verify.set_defaults(handler=cmd_verify)
+
+    keygen = subparsers.add_parser("keygen", help="Generate Crypt4GH key pairs")
+    keygen.add_argument("--name", action="append", required=True,
+                        help="Key pair name (repeat to create several pairs at once)")
+    keygen.add_argument("-j", "--jobs", type=int,
+                        help="Worker processes for passphrase-protected keys (default: all CPU cores)")
+    keygen.add_argument("-o", "--output-dir", required=True, help="Directory for the key files")
+    passphrase = keygen.add_mutually_exclusive_group()
+    passphrase.add_argument("--passphrase-env", help="Read the passphrase from this environment variable")
+    passphrase.add_argument("--no-passphrase", action="store_true", help="Leave the private key unencrypted")
+    keygen.set_defaults(handler=cmd_keygen, input=None, batch=None)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, "count", 1) <= 0:
+        parser.error("--count must be a positive number")
+    try:
+        args.handler(args)
+    except BrokenPipeError:
+        # The reader went away (e.g. "| head"); stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    except (CliError, SaveError, ValueError, OSError, ImportError) as e:
+        print(f"{parser.prog}: error: {str(e)}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
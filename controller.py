@@ -1,18 +1,24 @@
 import wx
 import os
 import logging
-import base64
-import subprocess
-from crypt4gh.lib import encrypt, decrypt
-from crypt4gh.keys import get_private_key, get_public_key
-from cryptography.hazmat.primitives.asymmetric import x25519
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
+import threading
+import time
+import batch
+import crypto
+from model import WRITERS
+from registry import REGISTRY_DIRNAME
 
 # Set up logging for debugging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Background ID generation: batches are resized to take about BATCH_SECONDS each
+BATCH_SECONDS = 0.2
+MIN_BATCH_SIZE = 1_000
+MAX_BATCH_SIZE = 1_000_000
+PROGRESS_INTERVAL = 0.1  # Seconds between progress dialog updates
+PROGRESS_RANGE = 1000
+
 class Controller:
     def __init__(self, model, view):
         self.model = model
@@ -27,20 +33,15 @@ class Controller:
         self.view.Bind(wx.EVT_BUTTON, self.on_process, self.view.process_btn)
         self.view.Bind(wx.EVT_BUTTON, self.on_generate_keys, self.view.generate_keys_btn)
 
-        # Timer for async generation
-        self.timer = wx.Timer(self.view)
-        self.view.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
-
-        # Generation state
-        self.ids = []
+        # Generation and encryption state, shared with the worker thread
+        self.writer = None
+        self.generated = 0
         self.num_ids = 0
         self.dest_path = ""
         self.file_type = ""
-        self.batch_size = 100
-        self.current_batch = 0
-        self.num_batches = 0
         self.progress_dialog = None
-        self.start_counter = 0
+        self.worker_thread = None
+        self.cancel_event = threading.Event()
 
         # Initial state
         self.view.radio_generate_id.SetValue(True)
@@ -67,62 +68,139 @@ class Controller:
             self.view.show_message("Please specify a destination directory.", "Error", wx.OK | wx.ICON_ERROR)
             return
 
+        public_keys = None
+        if self.view.get_encrypt_output():
+            if not WRITERS[file_type].encryptable:
+                self.view.show_message(f"{file_type} files cannot be encrypted while they are written. Please choose another file type.", "Error", wx.OK | wx.ICON_ERROR)
+                return
+            recipient_paths = self.view.ask_public_keys("Select the recipients' public keys")
+            if not recipient_paths:
+                self.view.show_message("ID generation cancelled.", "Info", wx.OK | wx.ICON_INFORMATION)
+                return
+            try:
+                public_keys = [crypto.load_public_key(path) for path in recipient_paths]
+            except ValueError as ve:
+                self.view.show_message(f"Validation error: {str(ve)}", "Error", wx.OK | wx.ICON_ERROR)
+                return
+
         # Initialize generation state
         self.num_ids = int(num_ids)
         self.dest_path = dest_path
         self.file_type = file_type
+        unique = self.view.get_unique()
+        self.model.set_unique(unique)
+        self.model.set_parallel(self.view.get_parallel())
+        self.model.set_check_character(self.view.get_check_character())
         self.model.set_seed(seed)
-        self.ids = []
-        self.current_batch = 0
-        self.num_batches = (self.num_ids + self.batch_size - 1) // self.batch_size  # Ceiling division
-        self.start_counter = 0
+        try:
+            if unique:
+                # Shared by every run that saves into this directory
+                self.model.open_registry(os.path.join(dest_path, REGISTRY_DIRNAME))
+            else:
+                self.model.close_registry()
+        except OSError as e:
+            self.view.show_message(f"Cannot open the ID registry: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            return
+
+        # Batches are streamed straight to disk (through the encryptor, if chosen)
+        # instead of being kept in memory
+        try:
+            self.writer = self.model.open_writer(dest_path, file_type, public_keys)
+        except Exception as e:
+            self.view.show_message(str(e), "Error", wx.OK | wx.ICON_ERROR)
+            return
+        self.generated = 0
+        self.cancel_event.clear()
 
-        # Initialize progress dialog
+        # Progress is shown in tenths of a percent so huge counts fit the dialog's range
         self.progress_dialog = wx.ProgressDialog(
             "Generating IDs",
             "Processing...",
-            maximum=self.num_batches,
+            maximum=PROGRESS_RANGE,
             parent=self.view,
-            style=wx.PD_APP_MODAL | wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT
+            style=wx.PD_APP_MODAL | wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_REMAINING_TIME
         )
 
-        # Start the timer to process batches
-        self.timer.Start(50)  # Update every 50ms
+        # Generation and saving run on a worker thread; the GUI only shows progress
+        self.worker_thread = threading.Thread(target=self.generate_in_background, daemon=True)
+        self.worker_thread.start()
 
-    def on_timer(self, event):
-        if self.current_batch >= self.num_batches:
-            # Generation complete
-            self.timer.Stop()
-            self.progress_dialog.Destroy()
-            try:
-                output_path = self.model.save_ids(self.ids, self.dest_path, self.file_type)
-                self.view.show_message(f"Generated {len(self.ids)} IDs and saved to {output_path}.", "Success", wx.OK | wx.ICON_INFORMATION)
-            except Exception as e:
-                self.view.show_message(str(e), "Error", wx.OK | wx.ICON_ERROR)
-            return
+    def generate_in_background(self):
+        batch_size = MIN_BATCH_SIZE
+        last_report = 0.0
+        try:
+            while self.generated < self.num_ids and not self.cancel_event.is_set():
+                batch_count = min(batch_size, self.num_ids - self.generated)
+                started = time.perf_counter()
+                batch_ids = self.model.generate_packed(batch_count, self.generated)
+                self.writer.write(batch_ids)
+                elapsed = time.perf_counter() - started
+                self.generated += batch_count
+
+                # Size the next batch from the measured rate so each one takes about
+                # BATCH_SECONDS, which keeps cancellation responsive at any speed
+                rate = batch_count / max(elapsed, 1e-6)
+                batch_size = int(min(MAX_BATCH_SIZE, max(MIN_BATCH_SIZE, rate * BATCH_SECONDS)))
+
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    wx.CallAfter(self.on_generation_progress, self.generated, rate)
+
+            if self.cancel_event.is_set():
+                self.finish_task(self.abort_writer("ID generation cancelled."), "Info", wx.ICON_INFORMATION)
+            else:
+                output_path = self.writer.close()
+                self.finish_task(f"Generated {self.generated} IDs and saved to {output_path}.", "Success", wx.ICON_INFORMATION)
+        except Exception as e:
+            logger.error(f"ID generation failed: {str(e)}")
+            self.finish_task(self.abort_writer(f"Error saving IDs: {str(e)}"), "Error", wx.ICON_ERROR)
+        finally:
+            self.writer = None
 
-        # Check if the user cancelled the operation
-        keep_going, _ = self.progress_dialog.Update(self.current_batch, f"Generating batch {self.current_batch + 1} of {self.num_batches}")
-        if not keep_going:
-            self.timer.Stop()
-            self.progress_dialog.Destroy()
-            self.view.show_message("ID generation cancelled.", "Info", wx.OK | wx.ICON_INFORMATION)
+    def abort_writer(self, reason):
+        # Keep whatever was generated, flushed and clearly marked as incomplete
+        try:
+            partial_path = self.writer.abort()
+            return f"{reason}\n\n{self.generated} IDs were saved to {partial_path}."
+        except Exception as e:
+            return f"{reason}\n\nThe partial output could not be saved: {str(e)}"
+
+    def finish_task(self, message, caption, icon):
+        wx.CallAfter(self.on_task_finished, message, caption, icon)
+
+    def on_generation_progress(self, generated, rate):
+        if self.progress_dialog is None:
             return
+        keep_going, _ = self.progress_dialog.Update(
+            generated * PROGRESS_RANGE // self.num_ids,
+            f"Generated {generated:,} of {self.num_ids:,} IDs ({rate:,.0f} IDs/s)"
+        )
+        if not keep_going:
+            self.cancel_event.set()
+            self.progress_dialog.Update(generated * PROGRESS_RANGE // self.num_ids, "Cancelling...")
 
-        # Generate a batch of IDs
-        batch_count = min(self.batch_size, self.num_ids - len(self.ids))
-        batch_ids = self.model.generate_ids(batch_count, self.start_counter)
-        self.ids.extend(batch_ids)
-        self.start_counter += batch_count
-        self.current_batch += 1
+    def on_task_finished(self, message, caption, icon):
+        if self.progress_dialog is not None:
+            self.progress_dialog.Destroy()
+            self.progress_dialog = None
+        self.worker_thread = None
+        self.view.show_message(message, caption, wx.OK | icon)
 
     def on_process(self, event):
         file_path = self.view.get_file_path()
+        folder_path = self.view.get_folder_path()
         key_path = self.view.get_key_path()
         action = self.view.get_encrypt_action()
 
-        if not file_path or not key_path:
-            self.view.show_message("Please select both a file and a key.", "Error", wx.OK | wx.ICON_ERROR)
+        if not (file_path or folder_path) or not key_path:
+            self.view.show_message("Please select a file or a folder, and a key.", "Error", wx.OK | wx.ICON_ERROR)
+            return
+        if action == "Re-key":
+            self.start_rekey(file_path, folder_path, key_path)
+            return
+        if folder_path:
+            self.start_batch(action, folder_path, key_path)
             return
 
         # Check if input file exists and is readable
@@ -131,101 +209,234 @@ class Controller:
             return
 
         # Determine output file path (append .c4gh for encryption, original name for decryption)
-        output_file = file_path + ".c4gh" if action == "Encrypt" else os.path.splitext(file_path)[0]
+        if action == "Encrypt":
+            output_file = crypto.encrypted_output_path(file_path)
+        else:
+            output_file = crypto.decrypted_output_path(file_path)
 
         # Check if output file can be written
         if os.path.exists(output_file):
             self.view.show_message(f"Output file {output_file} already exists. Please remove it or choose a different input file.", "Error", wx.OK | wx.ICON_ERROR)
             return
 
-        # Prompt for passphrase if decrypting with an encrypted private key
-        passphrase = None
-        if action == "Decrypt":
+        key = self.load_key(action, key_path)
+        if key is None:
+            return
+
+        self.cancel_event.clear()
+        self.progress_dialog = wx.ProgressDialog(
+            f"{action}ing {os.path.basename(file_path)}",
+            "Processing...",
+            maximum=PROGRESS_RANGE,
+            parent=self.view,
+            style=wx.PD_APP_MODAL | wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME
+        )
+
+        # Multi-GB files take minutes, so crypt4gh runs on a worker thread like generation
+        self.worker_thread = threading.Thread(target=self.process_in_background,
+                                              args=(action, file_path, output_file, key), daemon=True)
+        self.worker_thread.start()
+
+    def load_key(self, action, key_path):
+        # Returns the recipient key list for "Encrypt" or the private key for "Decrypt",
+        # or None after telling the user why not
+
+        def ask_passphrase():
+            # Only asked when the key is protected and not already in the session key cache
             passphrase_dialog = wx.TextEntryDialog(
                 self.view,
-                "Enter passphrase for the private key (if encrypted):",
+                "Enter passphrase for the private key:",
                 "Passphrase for Private Key",
                 "",
                 style=wx.TE_PASSWORD | wx.OK | wx.CANCEL
             )
-            if passphrase_dialog.ShowModal() == wx.ID_OK:
-                passphrase = passphrase_dialog.GetValue().encode() if passphrase_dialog.GetValue() else None
-            else:
+            try:
+                if passphrase_dialog.ShowModal() != wx.ID_OK:
+                    raise crypto.OperationCancelled()
+                return passphrase_dialog.GetValue().encode() or None
+            finally:
                 passphrase_dialog.Destroy()
-                self.view.show_message("Decryption cancelled.", "Info", wx.OK | wx.ICON_INFORMATION)
-                return
-            passphrase_dialog.Destroy()
 
+        # Keys are loaded here so key errors show up before any output is created
         try:
-            with open(file_path, 'rb') as f_in, open(output_file, 'wb') as f_out:
-                if action == "Encrypt":
-                    # Load and validate recipient's public key
-                    try:
-                        public_key = get_public_key(key_path)
-                        logger.debug(f"Public key object: {public_key}, Type: {type(public_key)}")
-                        # Log key file contents
-                        with open(key_path, 'r') as f:
-                            key_content = f.read()
-                            logger.debug(f"Public key file content:\n{key_content}")
-                        # Attempt to extract raw key bytes
-                        raw_bytes = None
-                        try:
-                            if isinstance(public_key, bytes):
-                                raw_bytes = public_key
-                                logger.debug(f"Public key is raw bytes: {base64.b64encode(raw_bytes).decode('utf-8')}")
-                            else:
-                                raw_bytes = public_key.public_bytes(
-                                    encoding=serialization.Encoding.Raw,
-                                    format=serialization.PublicFormat.Raw
-                                )
-                                logger.debug(f"Public key raw bytes: {base64.b64encode(raw_bytes).decode('utf-8')}")
-                        except AttributeError:
-                            logger.debug("Public key object does not support public_bytes")
-                    except Exception as e:
-                        raise ValueError(f"Failed to load public key: {str(e)}")
-                    if not public_key:
-                        raise ValueError("Public key is None or invalid.")
-                    # Try encryption with both key object and raw bytes
-                    key_attempts = [(0, public_key)]
-                    if raw_bytes:
-                        key_attempts.append((0, raw_bytes))
-                    for attempt_key in key_attempts:
-                        try:
-                            logger.debug(f"Encrypting with key tuple: {attempt_key}")
-                            encrypt(
-                                [attempt_key],  # Try method 0 (X25519)
-                                None,  # No sender private key
-                                f_in,
-                                f_out
-                            )
-                            self.view.show_message(f"Encrypted {os.path.basename(file_path)} to {os.path.basename(output_file)}.", "Success", wx.OK | wx.ICON_INFORMATION)
-                            break
-                        except Exception as e:
-                            logger.error(f"Encryption failed with key {attempt_key}: {str(e)}")
-                            if attempt_key == key_attempts[-1]:
-                                raise ValueError(f"All encryption attempts failed: {str(e)}")
-                elif action == "Decrypt":
-                    # Load and validate user's private key
-                    try:
-                        private_key = get_private_key(key_path, lambda: passphrase)
-                        logger.debug(f"Private key object: {private_key}, Type: {type(private_key)}")
-                    except Exception as e:
-                        raise ValueError(f"Failed to load private key: {str(e)}")
-                    if not private_key:
-                        raise ValueError("Private key is None or invalid.")
-                    # Decrypt the file
-                    logger.debug(f"Decrypting with key tuple: [(0, {private_key})]")
-                    decrypt(
-                        [(0, private_key)],  # Method 0 (X25519)
-                        None,  # No sender public key
-                        f_in,
-                        f_out
-                    )
-                    self.view.show_message(f"Decrypted {os.path.basename(file_path)} to {os.path.basename(output_file)}.", "Success", wx.OK | wx.ICON_INFORMATION)
+            if action == "Encrypt":
+                return [crypto.load_public_key(key_path)]
+            return crypto.load_private_key(key_path, ask_passphrase)
+        except crypto.OperationCancelled:
+            self.view.show_message("Decryption cancelled.", "Info", wx.OK | wx.ICON_INFORMATION)
+            return None
         except ValueError as ve:
             self.view.show_message(f"Validation error: {str(ve)}", "Error", wx.OK | wx.ICON_ERROR)
+            return None
+
+    def process_in_background(self, action, file_path, output_file, key):
+        total = os.path.getsize(file_path)
+        started = time.monotonic()
+        last_report = 0.0
+
+        def progress(done):
+            # Called by the stream wrapper for every segment crypt4gh reads
+            nonlocal last_report
+            if self.cancel_event.is_set():
+                raise crypto.OperationCancelled()
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                wx.CallAfter(self.on_process_progress, action, done, total, done / max(now - started, 1e-6))
+
+        try:
+            if action == "Encrypt":
+                crypto.encrypt_file(file_path, output_file, key, progress)
+            else:
+                crypto.decrypt_file(file_path, output_file, key, progress)
+            self.finish_task(f"{action}ed {os.path.basename(file_path)} to {os.path.basename(output_file)}.", "Success", wx.ICON_INFORMATION)
+        except crypto.OperationCancelled:
+            self.remove_partial_output(output_file)
+            self.finish_task(f"{action}ion cancelled. The partial output was removed.", "Info", wx.ICON_INFORMATION)
         except Exception as e:
-            self.view.show_message(f"Failed to {action.lower()} file: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            logger.error(f"Failed to {action.lower()} {file_path}: {str(e)}")
+            self.remove_partial_output(output_file)
+            self.finish_task(f"Failed to {action.lower()} file: {str(e)}", "Error", wx.ICON_ERROR)
+
+    def on_process_progress(self, action, done, total, rate):
+        if self.progress_dialog is None:
+            return
+        value = min(done * PROGRESS_RANGE // max(total, 1), PROGRESS_RANGE)
+        remaining = int((total - done) / rate) if rate else 0
+        eta = f"{remaining // 3600}:{remaining // 60 % 60:02d}:{remaining % 60:02d}"
+        keep_going, _ = self.progress_dialog.Update(
+            value,
+            f"{action}ed {done / 1e6:,.1f} of {total / 1e6:,.1f} MB ({rate / 1e6:,.1f} MB/s, {eta} left)"
+        )
+        if not keep_going:
+            self.cancel_event.set()
+            self.progress_dialog.Update(value, "Cancelling...")
+
+    def start_batch(self, action, folder_path, key_path):
+        inputs = batch.find_inputs(folder_path, action)
+        if not inputs:
+            kind = "unencrypted" if action == "Encrypt" else crypto.ENCRYPTED_EXTENSION
+            self.view.show_message(f"No {kind} files found in {folder_path}.", "Error", wx.OK | wx.ICON_ERROR)
+            return
+        key = self.load_key(action, key_path)
+        if key is None:
+            return
+
+        self.cancel_event.clear()
+        self.progress_dialog = wx.ProgressDialog(
+            f"{action}ing {len(inputs)} files",
+            "Processing...",
+            maximum=len(inputs),
+            parent=self.view,
+            style=wx.PD_APP_MODAL | wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_REMAINING_TIME
+        )
+        manifest_path = batch.default_manifest_path(folder_path, action)
+        self.worker_thread = threading.Thread(target=self.batch_in_background,
+                                              args=(action, inputs, key, manifest_path), daemon=True)
+        self.worker_thread.start()
+
+    def batch_in_background(self, action, inputs, key, manifest_path):
+        started = time.monotonic()
+        processed = 0
+
+        def progress(result, finished, total):
+            nonlocal processed
+            if result["status"] == "done":
+                processed += result["bytes"]
+            rate = processed / max(time.monotonic() - started, 1e-6)
+            wx.CallAfter(self.on_batch_progress, finished, total, rate)
+
+        try:
+            manifest = batch.run_batch(inputs, action, key, manifest_path, progress=progress,
+                                       cancel_event=self.cancel_event)
+        except Exception as e:
+            logger.error(f"Batch {action.lower()}ion failed: {str(e)}")
+            self.finish_task(f"Failed to {action.lower()} files: {str(e)}", "Error", wx.ICON_ERROR)
+            return
+        summary = manifest["summary"]
+        message = (f"{action}ed {summary['done']} of {len(inputs)} files: {summary['skipped']} skipped (output exists), "
+                   f"{summary['failed']} failed, {summary['cancelled']} cancelled.\n\nDetails: {manifest_path}")
+        if summary["failed"]:
+            self.finish_task(message, "Error", wx.ICON_ERROR)
+        else:
+            self.finish_task(message, "Success", wx.ICON_INFORMATION)
+
+    def on_batch_progress(self, finished, total, rate=None):
+        if self.progress_dialog is None:
+            return
+        speed = f" ({rate / 1e6:,.1f} MB/s)" if rate is not None else ""
+        keep_going, _ = self.progress_dialog.Update(finished, f"Processed {finished:,} of {total:,} files{speed}")
+        if not keep_going:
+            self.cancel_event.set()
+            self.progress_dialog.Update(finished, "Cancelling...")
+
+    def start_rekey(self, file_path, folder_path, key_path):
+        # Files are re-keyed in place: only their headers are rewritten
+        if folder_path:
+            inputs = batch.find_inputs(folder_path, "Decrypt")
+            if not inputs:
+                self.view.show_message(f"No {crypto.ENCRYPTED_EXTENSION} files found in {folder_path}.", "Error", wx.OK | wx.ICON_ERROR)
+                return
+        elif os.path.isfile(file_path):
+            inputs = [file_path]
+        else:
+            self.view.show_message(f"Input file {file_path} does not exist.", "Error", wx.OK | wx.ICON_ERROR)
+            return
+
+        recipient_paths = self.view.ask_public_keys()
+        if not recipient_paths:
+            self.view.show_message("Re-key cancelled.", "Info", wx.OK | wx.ICON_INFORMATION)
+            return
+        try:
+            public_keys = [crypto.load_public_key(path) for path in recipient_paths]
+        except ValueError as ve:
+            self.view.show_message(f"Validation error: {str(ve)}", "Error", wx.OK | wx.ICON_ERROR)
+            return
+        private_key = self.load_key("Re-key", key_path)
+        if private_key is None:
+            return
+
+        self.cancel_event.clear()
+        self.progress_dialog = wx.ProgressDialog(
+            f"Re-keying {len(inputs)} files",
+            "Processing...",
+            maximum=len(inputs),
+            parent=self.view,
+            style=wx.PD_APP_MODAL | wx.PD_AUTO_HIDE | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME
+        )
+        self.worker_thread = threading.Thread(target=self.rekey_in_background,
+                                              args=(inputs, private_key, public_keys), daemon=True)
+        self.worker_thread.start()
+
+    def rekey_in_background(self, inputs, private_key, public_keys):
+        rekeyed, copied, failed = 0, 0, []
+        for index, file_path in enumerate(inputs):
+            if self.cancel_event.is_set():
+                break
+            try:
+                if not crypto.rekey_file(file_path, private_key, public_keys):
+                    copied += 1
+                rekeyed += 1
+            except Exception as e:
+                logger.error(f"Failed to re-key {file_path}: {str(e)}")
+                failed.append(f"{os.path.basename(file_path)}: {str(e)}")
+            wx.CallAfter(self.on_batch_progress, index + 1, len(inputs))
+
+        message = f"Re-keyed {rekeyed} of {len(inputs)} files for {len(public_keys)} recipient(s)."
+        if copied:
+            message += f" {copied} had to be copied because their header changed size."
+        if failed:
+            message += "\n\n" + "\n".join(failed[:10]) + ("\n..." if len(failed) > 10 else "")
+            self.finish_task(message, "Error", wx.ICON_ERROR)
+        else:
+            self.finish_task(message, "Success", wx.ICON_INFORMATION)
+
+    def remove_partial_output(self, output_file):
+        if os.path.exists(output_file):
+            try:
+                os.remove(output_file)
+            except OSError as e:
+                logger.error(f"Could not remove partial output {output_file}: {str(e)}")
 
     def on_generate_keys(self, event):
         logger.debug("Starting key generation")
@@ -245,7 +456,7 @@ class Controller:
         logger.debug("Prompting for key name")
         key_name_dialog = wx.TextEntryDialog(
             self.view,
-            "Enter a name for the key pair:",
+            "Enter a name for the key pair (separate several names with commas):",
             "Key Name",
             "",
             style=wx.OK | wx.CANCEL
@@ -255,28 +466,26 @@ class Controller:
             key_name_dialog.Destroy()
             self.view.show_message("Key generation cancelled.", "Info", wx.OK | wx.ICON_INFORMATION)
             return
-        key_name = key_name_dialog.GetValue().strip()
+        key_names = [name.strip() for name in key_name_dialog.GetValue().split(",")]
         key_name_dialog.Destroy()
-        logger.debug(f"Key name entered: {key_name}")
+        logger.debug(f"Key names entered: {key_names}")
 
-        # Validate key name
-        if not key_name or not all(c.isalnum() or c == '_' for c in key_name):
+        # Validate key names
+        if not all(crypto.is_valid_key_name(key_name) for key_name in key_names):
             logger.debug("Invalid key name")
-            self.view.show_message("Key name must be non-empty and contain only alphanumeric characters or underscores.", "Error", wx.OK | wx.ICON_ERROR)
+            self.view.show_message("Key names must be non-empty and contain only alphanumeric characters or underscores.", "Error", wx.OK | wx.ICON_ERROR)
+            return
+        if len(set(key_names)) != len(key_names):
+            self.view.show_message("Each key name may only be given once.", "Error", wx.OK | wx.ICON_ERROR)
             return
-
-        # Define paths for private and public keys using the key name
-        private_key_path = os.path.join(output_dir, f"{key_name}_private.sec")
-        public_key_path = os.path.join(output_dir, f"{key_name}_public.pub")
-        logger.debug(f"Private key path: {private_key_path}")
-        logger.debug(f"Public key path: {public_key_path}")
 
         # Check if keys already exist
-        for key_path in (private_key_path, public_key_path):
-            if os.path.isfile(key_path):
-                logger.debug(f"Key file already exists: {key_path}")
-                self.view.show_message(f"Key {key_path} already exists. Please remove it or choose a different name.", "Error", wx.OK | wx.ICON_ERROR)
-                return
+        for key_name in key_names:
+            for key_path in crypto.key_pair_paths(output_dir, key_name):
+                if os.path.isfile(key_path):
+                    logger.debug(f"Key file already exists: {key_path}")
+                    self.view.show_message(f"Key {key_path} already exists. Please remove it or choose a different name.", "Error", wx.OK | wx.ICON_ERROR)
+                    return
 
         # Prompt for passphrase
         logger.debug("Prompting for passphrase")
@@ -297,88 +506,18 @@ class Controller:
         passphrase_dialog.Destroy()
         logger.debug(f"Passphrase provided: {'Yes' if passphrase else 'No'}")
 
-        try:
-            # Generate keys with crypt4gh-keygen
-            logger.debug("Attempting key generation with crypt4gh-keygen")
-            temp_private_key_path = os.path.join(output_dir, f"{key_name}_temp_private.sec")
-            try:
-                cmd = ["crypt4gh-keygen", "--sk", temp_private_key_path, "--pk", public_key_path]
-                result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-                logger.debug(f"crypt4gh-keygen output: {result.stdout}")
-
-                # Read and log key file contents
-                with open(public_key_path, 'r') as f:
-                    public_content = f.read()
-                    logger.debug(f"Public key file content:\n{public_content}")
-                with open(temp_private_key_path, 'r') as f:
-                    private_content = f.read()
-                    logger.debug(f"Temporary private key file content:\n{private_content}")
-
-                # Handle passphrase encryption for private key
-                if passphrase:
-                    logger.debug("Encrypting private key with passphrase using cryptography")
-                    # Load the crypt4gh-generated private key
-                    try:
-                        temp_private_key = get_private_key(temp_private_key_path, lambda: None)
-                        private_bytes = temp_private_key.private_bytes(
-                            encoding=serialization.Encoding.Raw,
-                            format=serialization.PrivateFormat.Raw
-                        )
-                        # Create a new private key object for encryption
-                        private_key = x25519.X25519PrivateKey.from_private_bytes(private_bytes)
-                        private_bytes_encrypted = private_key.private_bytes(
-                            encoding=serialization.Encoding.PEM,
-                            format=serialization.PrivateFormat.PKCS8,
-                            encryption_algorithm=serialization.BestAvailableEncryption(passphrase)
-                        )
-                        private_content = private_bytes_encrypted.decode('utf-8')
-                        with open(private_key_path, 'w') as f:
-                            f.write(private_content)
-                        logger.debug(f"Encrypted private key file content:\n{private_content}")
-                    finally:
-                        # Clean up temporary private key
-                        if os.path.exists(temp_private_key_path):
-                            os.remove(temp_private_key_path)
-                            logger.debug("Removed temporary private key file")
-                else:
-                    # No passphrase, use the generated private key as-is
-                    os.rename(temp_private_key_path, private_key_path)
-                    with open(private_key_path, 'r') as f:
-                        private_content = f.read()
-                        logger.debug(f"Private key file content:\n{private_content}")
-
-                # Validate public key
-                logger.debug("Validating public key with crypt4gh")
-                validated_public_key = get_public_key(public_key_path)
-                if not validated_public_key:
-                    logger.error("crypt4gh failed to load public key")
-                    raise ValueError("crypt4gh failed to load public key")
-                logger.debug(f"Public key object: {validated_public_key}, Type: {type(validated_public_key)}")
-                try:
-                    public_bytes = validated_public_key.public_bytes(
-                        encoding=serialization.Encoding.Raw,
-                        format=serialization.PublicFormat.Raw
-                    )
-                    logger.debug(f"Public key raw bytes: {base64.b64encode(public_bytes).decode('utf-8')}")
-                except AttributeError:
-                    logger.debug("Public key object does not support public_bytes")
-
-            except (subprocess.CalledProcessError, FileNotFoundError) as e:
-                logger.error(f"crypt4gh-keygen failed: {str(e)}")
-                raise ValueError(f"Failed to generate keys with crypt4gh-keygen: {str(e)}")
-
-            # Set secure file permissions
-            logger.debug("Setting file permissions")
-            os.chmod(private_key_path, 0o600)
-            os.chmod(public_key_path, 0o644)
+        if len(key_names) > 1:
+            self.generate_key_pairs(output_dir, key_names, passphrase)
+            return
 
+        try:
+            private_key_path, public_key_path = crypto.generate_key_pair(output_dir, key_names[0], passphrase)
             logger.debug("Key generation and validation successful")
             self.view.show_message(
                 f"Generated private key at {private_key_path} and public key at {public_key_path}.",
                 "Success",
                 wx.OK | wx.ICON_INFORMATION
             )
-
         except OSError as e:
             logger.error(f"OSError during key generation: {str(e)}")
             self.view.show_message(f"Failed to write keys: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
@@ -387,4 +526,16 @@ class Controller:
             self.view.show_message(f"Key generation failed: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
         except Exception as e:
             logger.error(f"Unexpected error during key generation: {str(e)}")
-            self.view.show_message(f"Unexpected error: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
\ No newline at end of file
+            self.view.show_message(f"Unexpected error: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+
+    def generate_key_pairs(self, output_dir, key_names, passphrase):
+        with wx.BusyCursor():
+            results = crypto.generate_key_pairs(output_dir, key_names, passphrase)
+        failed = [f"{key_name}: {error}" for key_name, _, error in results if error]
+        message = f"Generated {len(results) - len(failed)} of {len(results)} key pairs in {output_dir}."
+        if failed:
+            logger.error(f"Key generation failed for {len(failed)} key pairs")
+            message += "\n\n" + "\n".join(failed[:10]) + ("\n..." if len(failed) > 10 else "")
+            self.view.show_message(message, "Error", wx.OK | wx.ICON_ERROR)
+        else:
+            self.view.show_message(message, "Success", wx.OK | wx.ICON_INFORMATION)
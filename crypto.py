@@ -0,0 +1,591 @@
+import os
+import logging
+import base64
+import contextlib
+import hashlib
+import io
+import mmap
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent import futures
+from lazy import lazy_import
+
+# Crypt4GH file encryption, decryption and key generation shared by the GUI and the
+# command line. Nothing here may import wx, and crypt4gh is only loaded once a file
+# is actually encrypted or decrypted.
+crypt4gh_lib = lazy_import("crypt4gh.lib")
+crypt4gh_keys = lazy_import("crypt4gh.keys")
+crypt4gh_header = lazy_import("crypt4gh.header")
+
+logger = logging.getLogger(__name__)
+
+ENCRYPTED_EXTENSION = ".c4gh"
+
+# Crypt4GH data layout: independent 64 KiB ChaCha20-Poly1305 segments, each stored as
+# a 12-byte nonce, the ciphertext and a 16-byte MAC
+SEGMENT_SIZE = 65536
+CIPHER_DIFF = 28
+CIPHER_SEGMENT_SIZE = SEGMENT_SIZE + CIPHER_DIFF
+
+# Segments per task of encrypt_file (4 MiB of input)
+SEGMENTS_PER_TASK = 64
+
+# Bytes per step when rekey_file has to copy the data segments
+REKEY_COPY_CHUNK = 16 * 2**20
+
+# Session cache of parsed keys, see KeyCache
+KEY_CACHE_SIZE = 16
+KEY_CACHE_TTL = 15 * 60  # Seconds
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+class ProgressStream:
+    # Wraps a file object and reports the running byte count of every read and write to
+    # progress(total). The callback runs on the thread doing the I/O and may raise
+    # (e.g. OperationCancelled) to abort crypt4gh between segments.
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self.bytes = 0
+
+    def _count(self, count):
+        self.bytes += count
+        self.progress(self.bytes)
+        return count
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self._count(len(data))
+        return data
+
+    def readinto(self, buffer):
+        return self._count(self.stream.readinto(buffer) or 0)
+
+    def write(self, data):
+        written = self.stream.write(data)
+        self._count(len(data) if written is None else written)
+        return written
+
+    def __getattr__(self, name):
+        # seek(), tell(), flush(), ... go straight to the wrapped stream
+        return getattr(self.stream, name)
+
+
+def encrypted_output_path(file_path):
+    return file_path + ENCRYPTED_EXTENSION
+
+
+def decrypted_output_path(file_path):
+    return os.path.splitext(file_path)[0]
+
+
+def is_valid_key_name(key_name):
+    return bool(key_name) and all(c.isalnum() or c == '_' for c in key_name)
+
+
+def key_pair_paths(output_dir, key_name):
+    private_key_path = os.path.join(output_dir, f"{key_name}_private.sec")
+    public_key_path = os.path.join(output_dir, f"{key_name}_public.pub")
+    return private_key_path, public_key_path
+
+
+class KeyCache:
+    # Parsed keys of this session, so repeated encryptions and decryptions skip parsing,
+    # the passphrase KDF and the passphrase prompt. Entries are keyed by (path, mtime,
+    # SHA-256 of the file), so an edited or replaced key file is never served from the
+    # cache; they expire ttl seconds after loading and the least recently used entry
+    # goes once there are more than max_entries; a daemon timer purges entries as they
+    # expire, so an idle session does not keep keys in the cache. Callers get a copy as
+    # bytes, so eviction never pulls a key from under a running operation. The cache
+    # overwrites its own bytearray with zeros when an entry leaves, but that does not
+    # erase the key from memory: the copies handed out (and those made by crypt4gh,
+    # PyNaCl and cryptography, which only take immutable bytes) stay until Python
+    # frees them. The TTL limits how long the cache keeps a key reachable, nothing more.
+    def __init__(self, max_entries=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # identity -> (key, expiry)
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, kind, key_path, loader):
+        identity = self._identity(kind, key_path)
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(identity)
+            if entry is not None:
+                self.entries.move_to_end(identity)
+                return bytes(entry[0])
+        key = loader()  # Outside the lock: it may prompt for a passphrase
+        with self.lock:
+            # Older versions of the same key file can never be hit again
+            for stale in [entry for entry in self.entries if entry[:2] == identity[:2]]:
+                self._drop(stale)
+            self.entries[identity] = (bytearray(key), time.monotonic() + self.ttl)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+            self._schedule()
+        return key
+
+    def clear(self):
+        with self.lock:
+            for identity in list(self.entries):
+                self._drop(identity)
+            self._schedule()
+
+    def _schedule(self):
+        # (Re)arms the timer for the earliest expiry; called with the lock held
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.entries:
+            earliest = min(expiry for _, expiry in self.entries.values())
+            self.timer = threading.Timer(max(0.0, earliest - time.monotonic()), self._purge)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _purge(self):
+        with self.lock:
+            self._expire()
+            self._schedule()
+
+    def _identity(self, kind, key_path):
+        path = os.path.realpath(key_path)
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+        return kind, path, mtime, digest
+
+    def _expire(self):
+        now = time.monotonic()
+        for identity in [identity for identity, (_, expiry) in self.entries.items() if expiry <= now]:
+            self._drop(identity)
+
+    def _drop(self, identity):
+        entry = self.entries.pop(identity, None)
+        if entry is not None:
+            key = entry[0]
+            key[:] = bytes(len(key))
+
+
+# Shared by the GUI (single files and folders) and the command line
+key_cache = KeyCache()
+
+
+def load_public_key(key_path):
+    def load():
+        try:
+            public_key = crypt4gh_keys.get_public_key(key_path)
+        except Exception as e:
+            raise ValueError(f"Failed to load public key: {str(e)}")
+        if not public_key:
+            raise ValueError("Public key is None or invalid.")
+        logger.debug(f"Public key raw bytes: {base64.b64encode(public_key).decode('utf-8')}")
+        return public_key
+
+    try:
+        return key_cache.load("public", key_path, load)
+    except OSError as e:
+        raise ValueError(f"Failed to load public key: {str(e)}")
+
+
+def load_private_key(key_path, passphrase_callback):
+    # passphrase_callback is only called when the key is protected by a passphrase and
+    # not already in the key cache; it may raise OperationCancelled
+    callback_error = None
+
+    def passphrase():
+        # crypt4gh wants a str; our callbacks return bytes or None
+        nonlocal callback_error
+        try:
+            value = passphrase_callback()
+        except Exception as e:
+            callback_error = e
+            raise
+        return value.decode() if isinstance(value, bytes) else (value or "")
+
+    def load():
+        try:
+            private_key = crypt4gh_keys.get_private_key(key_path, passphrase)
+        except (Exception, SystemExit) as e:
+            # crypt4gh calls sys.exit() on a wrong passphrase or a failing callback
+            if callback_error is not None:
+                raise callback_error
+            reason = "invalid key or passphrase" if isinstance(e, SystemExit) else str(e)
+            raise ValueError(f"Failed to load private key: {reason}")
+        if not private_key:
+            raise ValueError("Private key is None or invalid.")
+        return private_key
+
+    try:
+        return key_cache.load("private", key_path, load)
+    except OSError as e:
+        raise ValueError(f"Failed to load private key: {str(e)}")
+
+
+def encrypt_stream(public_keys, f_in, f_out):
+    # The header is signed with a throwaway sender key, as crypt4gh's own CLI does
+    sender_key = os.urandom(32)
+    keys = [(0, sender_key, public_key) for public_key in public_keys]  # Method 0 (X25519)
+    crypt4gh_lib.encrypt(keys, f_in, f_out)
+
+
+def decrypt_stream(private_key, f_in, f_out):
+    crypt4gh_lib.decrypt([(0, private_key, None)], f_in, f_out)  # Method 0 (X25519), no sender check
+
+
+def _make_header(public_keys):
+    # A fresh session key and the Crypt4GH header that gives it to every recipient
+    session_key = os.urandom(32)
+    sender_key = os.urandom(32)
+    keys = [(0, sender_key, public_key) for public_key in public_keys]  # Method 0 (X25519)
+    packet = crypt4gh_header.make_packet_data_enc(0, session_key)
+    return session_key, crypt4gh_header.serialize(crypt4gh_header.encrypt(packet, keys))
+
+
+class Crypt4GHWriter(io.RawIOBase):
+    # Write-only file object that turns whatever is written to it into a Crypt4GH file
+    # on target: the header right away, then one encrypted segment per 64 KiB. Only the
+    # current segment is held in memory; close() writes the last, shorter one. Wrap it
+    # in io.TextIOWrapper to write text.
+    def __init__(self, target, public_keys, close_target=True):
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+        session_key, header = _make_header(public_keys)
+        self.cipher = ChaCha20Poly1305(session_key)
+        self.target = target
+        self.close_target = close_target
+        self.pending = bytearray()
+        self.position = 0
+        target.write(header)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position  # Plaintext bytes written so far
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        data = memoryview(data).cast("B")
+        self.pending += data
+        full = len(self.pending) - len(self.pending) % SEGMENT_SIZE
+        for start in range(0, full, SEGMENT_SIZE):
+            self._write_segment(self.pending[start:start + SEGMENT_SIZE])
+        del self.pending[:full]
+        self.position += len(data)
+        return len(data)
+
+    def _write_segment(self, segment):
+        nonce = os.urandom(12)
+        self.target.write(nonce + self.cipher.encrypt(nonce, bytes(segment), None))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.pending:
+                self._write_segment(self.pending)
+                self.pending.clear()
+            self.target.flush()
+            if self.close_target:
+                self.target.close()
+        finally:
+            super().close()
+
+
+def _encrypt_segments(cipher, source, target, header_size, first, last):
+    # Encrypts segments [first, last) straight from the input map into their final
+    # place in the output map. Segments never overlap, so tasks need no locking.
+    for segment in range(first, last):
+        plain = source[segment * SEGMENT_SIZE:(segment + 1) * SEGMENT_SIZE]
+        start = header_size + segment * CIPHER_SEGMENT_SIZE
+        out = target[start:start + len(plain) + CIPHER_DIFF]
+        nonce = os.urandom(12)
+        out[:12] = nonce
+        if hasattr(cipher, "encrypt_into"):  # cryptography >= 45: no intermediate bytes
+            cipher.encrypt_into(nonce, plain, None, out[12:])
+        else:
+            out[12:] = cipher.encrypt(nonce, plain, None)
+    return (last - first) * SEGMENT_SIZE
+
+
+def encrypt_file(file_path, output_file, public_keys, progress=None, threads=None):
+    # Same output format as crypt4gh.lib.encrypt (without edit list), but the input is
+    # memory-mapped and segments are encrypted on a thread pool directly into the
+    # preallocated, memory-mapped output. progress(bytes_read) follows the input.
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+    session_key, header = _make_header(public_keys)
+    size = os.path.getsize(file_path)
+    segments = -(-size // SEGMENT_SIZE)
+    with open(file_path, 'rb') as f_in, open(output_file, 'w+b') as f_out:
+        f_out.write(header)
+        if not size:
+            return
+        f_out.truncate(len(header) + size + segments * CIPHER_DIFF)
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as in_map, \
+                mmap.mmap(f_out.fileno(), 0) as out_map:
+            source, target = memoryview(in_map), memoryview(out_map)
+            try:
+                cipher = ChaCha20Poly1305(session_key)
+                tasks = [(first, min(first + SEGMENTS_PER_TASK, segments))
+                         for first in range(0, segments, SEGMENTS_PER_TASK)]
+                with futures.ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+                    pending = [executor.submit(_encrypt_segments, cipher, source, target, len(header), first, last)
+                               for first, last in tasks]
+                    done = 0
+                    try:
+                        for future in futures.as_completed(pending):
+                            done += future.result()
+                            if progress:
+                                progress(min(done, size))
+                    except BaseException:
+                        for future in pending:
+                            future.cancel()
+                        raise
+                out_map.flush()
+            finally:
+                source.release()
+                target.release()
+
+
+def decrypt_file(file_path, output_file, private_key, progress=None):
+    with open(file_path, 'rb') as f_in, open(output_file, 'wb') as f_out:
+        decrypt_stream(private_key, ProgressStream(f_in, progress) if progress else f_in, f_out)
+
+
+def _decrypt_segment(ciphers, data, segment):
+    for cipher in ciphers:
+        try:
+            return cipher.decrypt(data[:12], data[12:], None)
+        except Exception:  # InvalidTag: try the next session key
+            pass
+    raise ValueError(f"Could not decrypt segment {segment}")
+
+
+def decrypt_range(private_key, f_in, f_out, offset=0, length=None):
+    # Writes plaintext bytes [offset, offset + length) of an encrypted file (length None:
+    # to the end). f_in must be seekable. Only the segments covering the range are read
+    # and decrypted, so a few KB out of a huge file take one or two segments. Files
+    # with an edit list go through crypt4gh, which applies it while skipping.
+    if offset < 0 or (length is not None and length < 0):
+        raise ValueError("Offset and length must not be negative")
+    if length == 0:
+        return
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+    session_keys, edit_list = crypt4gh_header.deconstruct(f_in, [(0, private_key, None)])  # Method 0 (X25519)
+    if edit_list is not None:
+        f_in.seek(0)
+        crypt4gh_lib.decrypt([(0, private_key, None)], f_in, f_out, offset=offset, span=length)
+        return
+
+    ciphers = [ChaCha20Poly1305(session_key) for session_key in session_keys]
+    data_start = f_in.tell()
+    segment, skip = divmod(offset, SEGMENT_SIZE)
+    f_in.seek(data_start + segment * CIPHER_SEGMENT_SIZE)
+    remaining = length
+    while remaining is None or remaining > 0:
+        data = f_in.read(CIPHER_SEGMENT_SIZE)
+        if len(data) <= CIPHER_DIFF:
+            break  # End of file
+        plain = _decrypt_segment(ciphers, data, segment)[skip:]
+        if remaining is not None:
+            plain = plain[:remaining]
+            remaining -= len(plain)
+        f_out.write(plain)
+        segment, skip = segment + 1, 0
+
+
+class _BufferWriter:
+    # File-like write() into a caller's preallocated buffer
+    def __init__(self, buffer):
+        self.target = memoryview(buffer).cast("B")
+        self.position = 0
+
+    def write(self, data):
+        self.target[self.position:self.position + len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def read_range(file_path, private_key, offset, length, buffer=None):
+    # decrypt_range for callers that want the bytes: returns them, or fills the given
+    # writable buffer (bytearray, memoryview, ...) and returns the number of bytes
+    with open(file_path, 'rb') as f_in:
+        if buffer is None:
+            out = io.BytesIO()
+            decrypt_range(private_key, f_in, out, offset, length)
+            return out.getvalue()
+        writer = _BufferWriter(buffer)
+        size = len(writer.target) if length is None else min(length, len(writer.target))
+        decrypt_range(private_key, f_in, writer, offset, size)
+        return writer.position
+
+
+def rekey_file(file_path, private_key, public_keys, keep_others=False):
+    # Gives an encrypted file a new list of recipients without touching its data: the
+    # header packets are decrypted with the holder's private key and encrypted again
+    # for public_keys. Packets the holder cannot read (other recipients) are dropped
+    # unless keep_others is set. Returns True when the header could be rewritten in
+    # place, which is the usual case as long as the number of recipients stays the same.
+    with open(file_path, 'rb') as f:
+        packets = list(crypt4gh_header.parse(f))
+        header_size = f.tell()
+    sender_key = os.urandom(32)
+    try:
+        packets = crypt4gh_header.reencrypt(packets, [(0, private_key, None)],  # Method 0 (X25519)
+                                            [(0, sender_key, public_key) for public_key in public_keys],
+                                            trim=not keep_others)
+    except ValueError:
+        raise ValueError("The private key is not a recipient of this file.")
+    header = crypt4gh_header.serialize(packets)
+
+    if len(header) == header_size:
+        # A single write of a few hundred bytes
+        with open(file_path, 'r+b') as f:
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    # The header changed size: write a new file next to the old one and swap them
+    temp_path = file_path + ".rekey.part"
+    try:
+        with open(file_path, 'rb') as f_in, open(temp_path, 'wb') as f_out:
+            f_out.write(header)
+            f_out.flush()
+            _copy_data(f_in, f_out, header_size, len(header))
+            os.fsync(f_out.fileno())
+        shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return False
+
+
+def _copy_data(f_in, f_out, source_offset, target_offset):
+    # In-kernel copy where available (and a reflink on filesystems that support it)
+    size = os.fstat(f_in.fileno()).st_size - source_offset
+    if hasattr(os, "copy_file_range"):
+        try:
+            while size > 0:
+                copied = os.copy_file_range(f_in.fileno(), f_out.fileno(), min(size, 2**30),
+                                            source_offset, target_offset)
+                if not copied:
+                    break
+                size -= copied
+                source_offset += copied
+                target_offset += copied
+            if size <= 0:
+                return
+        except OSError:
+            pass  # e.g. across filesystems on older kernels; copy the rest below
+    f_in.seek(source_offset)
+    f_out.seek(target_offset)
+    shutil.copyfileobj(f_in, f_out, REKEY_COPY_CHUNK)
+    f_out.flush()
+
+
+def _write_new_file(path, data, mode):
+    # Atomic and never overwrites: the data goes to a temporary file first, which is
+    # then linked (renamed on Windows) to its name only if that name is still free.
+    # Filesystems without hard links (FAT/exFAT drives, some SMB shares) get the file
+    # created exclusively and written in place instead.
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), mode)
+    try:
+        _write_fd(fd, data)
+        os.chmod(temp_path, mode)  # Whatever the umask
+        if os.name == "nt":
+            os.rename(temp_path, path)  # Fails if path exists
+        else:
+            try:
+                os.link(temp_path, path)  # Fails if path exists
+            except FileExistsError:
+                raise
+            except OSError:
+                _write_in_place(path, data, mode)
+    except FileExistsError:
+        raise FileExistsError(f"Key {path} already exists.")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _write_fd(fd, data):
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_in_place(path, data, mode):
+    # Not atomic, but still never overwrites; a partial file is removed on failure
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), mode)
+    try:
+        _write_fd(fd, data)
+    except BaseException:
+        os.remove(path)
+        raise
+
+
+def generate_key_pair(output_dir, key_name, passphrase):
+    # Crypt4GH key pair written in-process, in the same format as crypt4gh-keygen: the
+    # private key (0600) is encrypted with the passphrase through crypt4gh's scrypt
+    # KDF if one is given, the public key is 0644
+    from cryptography.hazmat.primitives.asymmetric import x25519
+
+    private_key_path, public_key_path = key_pair_paths(output_dir, key_name)
+    logger.debug(f"Private key path: {private_key_path}")
+    logger.debug(f"Public key path: {public_key_path}")
+
+    secret = os.urandom(32)
+    public_key = x25519.X25519PrivateKey.from_private_bytes(secret).public_key().public_bytes_raw()
+    if passphrase:
+        encoded = crypt4gh_keys.c4gh.encode_private_key(secret, passphrase, key_name.encode())
+    else:
+        # The user chose no passphrase; crypt4gh would print a warning about it to stderr
+        with contextlib.redirect_stderr(io.StringIO()):
+            encoded = crypt4gh_keys.c4gh.encode_private_key(secret, None, key_name.encode())
+
+    _write_new_file(private_key_path, b"-----BEGIN CRYPT4GH PRIVATE KEY-----\n" + base64.b64encode(encoded)
+                    + b"\n-----END CRYPT4GH PRIVATE KEY-----\n", 0o600)
+    try:
+        _write_new_file(public_key_path, b"-----BEGIN CRYPT4GH PUBLIC KEY-----\n" + base64.b64encode(public_key)
+                        + b"\n-----END CRYPT4GH PUBLIC KEY-----\n", 0o644)
+    except BaseException:
+        os.remove(private_key_path)  # Never leave half a pair
+        raise
+    return private_key_path, public_key_path
+
+
+def generate_key_pairs(output_dir, key_names, passphrase, workers=None):
+    # Bulk version of generate_key_pair, e.g. one pair per site of a consortium. With a
+    # passphrase every pair costs a scrypt run, so pairs are created on a process pool.
+    # Returns (key_name, paths, error) per name, in order; error is None on success.
+    def outcome(future):
+        try:
+            return future.result(), None
+        except (OSError, ValueError) as e:
+            return None, str(e)
+
+    if passphrase and len(key_names) > 1:
+        executor = futures.ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(key_names)))
+    else:
+        executor = futures.ThreadPoolExecutor(max_workers=1)  # Unencrypted keys take microseconds
+    with executor:
+        pending = [executor.submit(generate_key_pair, output_dir, key_name, passphrase) for key_name in key_names]
+        return [(key_name, *outcome(future)) for key_name, future in zip(key_names, pending)]
@@ -6,7 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('locale', 'locale')],
-    hiddenimports=[],
+    hiddenimports=['numpy', 'openpyxl', 'pyarrow.parquet', 'crypt4gh.lib', 'crypt4gh.keys', 'pandas', 'sqlite3'],  # Loaded through lazy_import()
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
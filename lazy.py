@@ -0,0 +1,21 @@
+import importlib.util
+import sys
+
+# Heavy dependencies (numpy, openpyxl, crypt4gh, ...) are only needed by some modes,
+# so modules bind them with lazy_import() and the actual import happens on first
+# attribute access. This keeps start-up of the GUI and the CLI fast; see
+# "python benchmark.py startup".
+
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
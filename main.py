@@ -1,9 +1,12 @@
+import multiprocessing
 import wx
 from model import Model
 from view import View
 from controller import Controller
 
 if __name__ == "__main__":
+    # Parallel ID generation starts worker processes; frozen builds need this
+    multiprocessing.freeze_support()
     app = wx.App()
     model = Model()
     view = View(None, None)  # Controller will be set in Controller init
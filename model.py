@@ -1,80 +1,921 @@
 import csv
+import gzip
+import hashlib
+import io
 import json
 import os
+import struct
+from concurrent import futures
 from datetime import datetime
-import numpy as np
+from functools import cache
+import crypto
+from lazy import lazy_import
+from registry import IdRegistry
+
+np = lazy_import("numpy")
+
+ID_LENGTH = 9
+CHARACTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"  # Alphanumeric characters (base-62)
+BASE = len(CHARACTERS)
+
+# Optional 10th character: Luhn mod 62 over the 9 ID characters (characters 1, 3, 5,
+# 7 and 9 are doubled). It catches every single mistyped character and almost every
+# swap of two neighbouring ones. The packed value never includes it; it is added
+# when IDs are turned into text.
+CHECK_LENGTH = ID_LENGTH + 1
+
+# IDs drawn per RNG call; bounds the temporary index matrix to ~72 MB
+GENERATION_CHUNK = 1_000_000
+
+# IDs per independently seeded block in parallel mode. Block k always covers
+# positions [k * PARALLEL_BLOCK, (k + 1) * PARALLEL_BLOCK) of a run, whichever
+# worker draws it, which is what makes the output independent of the worker count.
+PARALLEL_BLOCK = 65_536
+
+# Feistel rounds of the counter-mode permutation (must be even, see _permute)
+COUNTER_ROUNDS = 10
+
+# Row limit of a single Excel worksheet, header included
+EXCEL_MAX_ROWS = 1_048_576
+
+# Fixed-width binary format (.ehid): a 16-byte header followed by one little-endian
+# uint64 per ID. Magic, format version, record size and ID length (10 when the IDs
+# are shown with a check character); there is no count, it follows from the file
+# size, so an aborted file is still readable.
+EHID_MAGIC = b"EHID"
+EHID_VERSION = 1
+EHID_HEADER = struct.Struct("<4sHHI4x")
+
+# Streaming compression for IdWriter: file name suffix and level per method. zstd
+# needs the optional 'zstandard' package. Random IDs only shrink to about 3/4 of
+# their size at any level, and gzip level 1 gets within 3% of level 6 in 60% of the time.
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+
+# Minimum sustained throughput of generate_ids on a single core (see benchmark.py)
+TARGET_IDS_PER_SECOND = 1_000_000
+
+
+def seed_to_entropy(seed):
+    # Numeric seeds are used as-is; text seeds go through a stable digest because
+    # Python's built-in hash() is salted per process and can be negative
+    seed = str(seed)
+    if seed.isdigit():
+        return int(seed)
+    return int.from_bytes(hashlib.blake2b(seed.encode("utf-8"), digest_size=16).digest(), "big")
+
+
+# IDs are handled as packed uint64 values, the base-62 number the 9 characters spell
+# (62^9 < 2^64). Text only exists at the I/O boundary: encode_ids() and decode_ids()
+# convert whole arrays at once, and the writers decode each batch as it is written.
+
+@cache
+def _codec_tables():
+    # Built on first use, so importing this module does not import numpy
+    alphabet = np.frombuffer(CHARACTERS.encode("ascii"), dtype=np.uint8)
+    lookup = np.full(256, BASE, dtype=np.uint8)  # BASE marks bytes that are not ID characters
+    lookup[alphabet] = np.arange(BASE, dtype=np.uint8)
+    place_values = BASE ** np.arange(ID_LENGTH - 1, -1, -1, dtype=np.int64)
+    # Luhn's doubled digit, 2d reduced to one digit of base 62: 2d // 62 + 2d % 62
+    doubled = np.arange(BASE, dtype=np.uint16) * 2
+    doubled = np.where(doubled >= BASE, doubled - BASE + 1, doubled).astype(np.uint16)
+    return alphabet, lookup, place_values, doubled
+
+
+def pack_indices(indices):
+    # (n, 9) character indices to packed IDs; 62^9 < 2^63, so the signed product cannot overflow
+    return (np.asarray(indices, dtype=np.int64) @ _codec_tables()[2]).view(np.uint64)
+
+
+def unpack_indices(packed):
+    # Packed IDs to an (n, 9) uint8 matrix of character indices
+    values = np.array(packed, dtype=np.uint64)
+    indices = np.empty((len(values), ID_LENGTH), dtype=np.uint8)
+    for column in range(ID_LENGTH - 1, -1, -1):
+        values, digits = np.divmod(values, np.uint64(BASE))
+        indices[:, column] = digits
+    return indices
+
+
+def check_indices(indices):
+    # Check character index for each row of an (n, 9) matrix of character indices;
+    # column by column, so no (n, 9) temporaries are created
+    indices = np.asarray(indices, dtype=np.uint8)
+    doubled = _codec_tables()[3]
+    total = np.zeros(len(indices), dtype=np.uint16)
+    for column in range(ID_LENGTH):
+        total += doubled[indices[:, column]] if column % 2 == 0 else indices[:, column]
+    return ((BASE - total % BASE) % BASE).astype(np.uint8)
+
+
+def _raw_ids(ids):
+    # Text IDs to an (n, 11) uint8 matrix of their bytes, NUL-padded; the spare byte
+    # after the check character catches IDs that are too long
+    try:
+        raw = np.asarray(ids, dtype=f"S{ID_LENGTH + 2}")
+    except UnicodeEncodeError:
+        # Non-ASCII characters become "?", which is not an ID character
+        raw = np.array([id.encode("ascii", "replace") if isinstance(id, str) else id for id in ids],
+                       dtype=f"S{ID_LENGTH + 2}")
+    return raw.view(np.uint8).reshape(-1, ID_LENGTH + 2)
+
+
+def _invalid_rows(raw, indices, check=None):
+    # Marks _raw_ids() rows with a character outside the alphabet, a wrong length or a
+    # wrong check character. check=True requires the check character, False forbids
+    # it and None accepts both, row by row.
+    invalid = raw[:, ID_LENGTH + 1] != 0
+    for column in range(ID_LENGTH):
+        invalid |= indices[:, column] == BASE
+    checked = raw[:, ID_LENGTH] != 0
+    if check is not None:
+        invalid |= checked != check
+    if checked.all() and not invalid.any():
+        invalid = indices[:, ID_LENGTH] != check_indices(indices[:, :ID_LENGTH])
+    else:
+        rows = np.flatnonzero(checked & ~invalid)
+        if len(rows):
+            invalid[rows] = indices[rows, ID_LENGTH] != check_indices(indices[rows, :ID_LENGTH])
+    return invalid
+
+
+def encode_ids(ids, check=None):
+    # Text IDs to a packed uint64 array; raises ValueError on anything that is not an
+    # ID. The check character, where present, is verified and dropped.
+    if isinstance(ids, np.ndarray) and ids.dtype == np.uint64:
+        return ids
+    raw = _raw_ids(ids)
+    indices = _codec_tables()[1][raw[:, :CHECK_LENGTH]]
+    invalid = _invalid_rows(raw, indices, check)
+    if invalid.any():
+        raise ValueError(f"Invalid eHealth ID: {ids[int(np.argmax(invalid))]!r}")
+    return pack_indices(indices[:, :ID_LENGTH])
+
+
+def validate_ids(ids, check=None):
+    # Positions (0-based) of the IDs that are not valid. With check=None the IDs are
+    # taken to carry a check character if most of them are 10 characters long, and
+    # then every one must have a correct one.
+    if isinstance(ids, np.ndarray) and ids.dtype == np.uint64:
+        return np.flatnonzero(ids >= np.uint64(BASE) ** np.uint64(ID_LENGTH))
+    raw = _raw_ids(ids)
+    if check is None:
+        # The bytes after the 9th and 10th character tell 9, 10 and other lengths apart
+        tenth, eleventh = raw[:, ID_LENGTH] != 0, raw[:, ID_LENGTH + 1] != 0
+        with_check = np.count_nonzero(tenth & ~eleventh)
+        check = with_check > np.count_nonzero(~tenth & (raw[:, ID_LENGTH - 1] != 0))
+    return np.flatnonzero(_invalid_rows(raw, _codec_tables()[1][raw[:, :CHECK_LENGTH]], check))
+
+
+def decode_ids(packed, check=False):
+    # Packed IDs to a list of str: map digits to ASCII bytes, reinterpret each row as
+    # a 9-byte string (10 with the check character) and decode the whole buffer at once
+    indices = unpack_indices(packed)
+    if check:
+        indices = np.column_stack((indices, check_indices(indices)))
+    buffer = np.ascontiguousarray(_codec_tables()[0][indices])
+    width = indices.shape[1]
+    return buffer.view(f"S{width}").ravel().astype(f"U{width}").tolist()
+
+
+def _draw_block(entropy, block, start, stop, base):
+    # Rows [start, stop) of a block, drawn from its own child stream of the run's
+    # SeedSequence. Runs in worker processes, so it must stay a module-level function.
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(block,)))
+    return rng.integers(0, base, size=(stop, ID_LENGTH))[start:].astype(np.uint8)
+
+
+def _mix(values, key):
+    # Keyed splitmix64 finaliser; uint64 arithmetic wraps, which is what we want
+    values = (values ^ key) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _permute(values, round_keys, base):
+    # Keyed bijection of [0, base^9): an alternating Feistel network over a 4-digit
+    # and a 5-digit half, like FF1 splits odd-length inputs. Every round is invertible
+    # whatever the round function, so distinct positions always give distinct IDs.
+    small = np.uint64(base ** (ID_LENGTH // 2))
+    large = np.uint64(base ** (ID_LENGTH - ID_LENGTH // 2))
+    left, right = np.divmod(values, large)
+    for round, key in enumerate(round_keys):
+        modulus = small if round % 2 == 0 else large
+        left, right = right, (left + _mix(right, key) % modulus) % modulus
+    return left * large + right
+
+
+class SaveError(Exception):
+    # Writing generated IDs to a file failed; the message says why
+    pass
+
+
+class IssuedIndex:
+    # Set of issued IDs packed as uint64, kept as a few sorted runs that are merged
+    # whenever a run grows to the size of the one before it (log-structured merge).
+    # Inserts cost amortised O(log n) per ID, lookups are one binary search per run
+    # and there are never more than log2(n) runs.
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, values):
+        # Lookups are far more cache friendly when values are sorted
+        found = np.zeros(len(values), dtype=bool)
+        for run in self.runs:
+            positions = np.searchsorted(run, values)
+            positions[positions == len(run)] = 0
+            found |= run[positions] == values
+        return found
+
+    def add(self, values):
+        run = np.sort(np.asarray(values, dtype=np.uint64))
+        run = run[np.concatenate(([True], run[1:] != run[:-1]))] if len(run) else run
+        while self.runs and len(self.runs[-1]) <= len(run):
+            # Both runs are sorted, so the stable sort is a linear merge
+            run = np.sort(np.concatenate([self.runs.pop(), run]), kind="stable")
+        if len(run):
+            self.runs.append(run)
+
+    def clear(self):
+        self.runs = []
 
-# For .xlsx support
-try:
-    from openpyxl import Workbook
-except ImportError:
-    Workbook = None
 
 class Model:
     def __init__(self):
         self.seed = None
-        self.characters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"  # Alphanumeric characters (base-62)
-        self.base = len(self.characters)
+        self.entropy = None
+        self.characters = CHARACTERS
+        self.base = BASE
         self.rng = None
+        self.unique = False
+        self.index = IssuedIndex()
+        self.registry = None
+        self.parallel = False
+        self.workers = os.cpu_count() or 1
+        self.executor = None
+        self.position = 0
+        self.counter = False
+        self.round_keys = None
+        self.check = False
 
     def set_seed(self, seed):
         self.seed = seed
         if seed:
-            try:
-                seed_value = int(seed) if str(seed).isdigit() else hash(seed)
-                self.rng = np.random.default_rng(seed_value)
-            except (ValueError, TypeError):
-                self.rng = np.random.default_rng(hash(seed))
+            self.entropy = seed_to_entropy(seed)
         else:
-            self.rng = np.random.default_rng()  # No seed = non-deterministic
+            self.entropy = np.random.SeedSequence().entropy  # No seed = non-deterministic
+        self.rng = np.random.default_rng(self.entropy)
+        self.round_keys = np.array([
+            int.from_bytes(hashlib.blake2b(f"{self.entropy}:{round}".encode("ascii"), digest_size=8,
+                                           person=b"ehealth-counter").digest(), "little")
+            for round in range(COUNTER_ROUNDS)
+        ], dtype=np.uint64)
+        self.position = 0
+        # Uniqueness is guaranteed per run; a new seed starts a new run
+        self.index.clear()
+
+    def set_counter(self, counter):
+        # Counter mode derives the ID at position i of a run directly from (seed, i),
+        # so any range can be produced on its own: resume after a cancel, or split a
+        # run across machines. IDs of one seed never collide, so the in-run index is
+        # not needed. An open registry is still checked and updated, since other seeds
+        # and random-mode runs can produce the same IDs; a position cannot be redrawn,
+        # so a hit is an error (this includes producing the same range twice).
+        self.counter = bool(counter)
+
+    def set_check_character(self, check):
+        # Text IDs get the Luhn mod 62 check character as a 10th character
+        self.check = check
+
+    def set_unique(self, unique):
+        self.unique = bool(unique)
+
+    def set_parallel(self, parallel, workers=None):
+        # Parallel mode draws IDs in fixed blocks, each from its own stream spawned from
+        # the seed, so a seed gives the same IDs for any number of workers (but not the
+        # same IDs as the sequential mode)
+        self.parallel = bool(parallel)
+        if workers and workers != self.workers:
+            self.shutdown_workers()
+            self.workers = workers
+
+    def shutdown_workers(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def open_registry(self, path):
+        # IDs issued by any earlier run against the same registry are never reissued
+        self.close_registry()
+        self.registry = IdRegistry(path)
+
+    def close_registry(self):
+        if self.registry is not None:
+            self.registry.close()
+            self.registry = None
 
     def _index_to_char(self, index):
         return self.characters[index % self.base]
 
-    def generate_ids(self, count, start_counter=0):
+    def _draw_indices(self, count):
+        # One call for the whole (count, 9) matrix. The default int64 dtype consumes
+        # the bit stream exactly like one integers() call per character did, so
+        # seeded runs keep producing the same IDs as before.
+        return self.rng.integers(0, self.base, size=(count, ID_LENGTH))
+
+    def _draw_parallel_indices(self, count):
+        # Like the sequential stream, each call continues where the previous one
+        # stopped; positions are split on block boundaries
+        tasks = []
+        position, end = self.position, self.position + count
+        while position < end:
+            block, start = divmod(position, PARALLEL_BLOCK)
+            stop = min(PARALLEL_BLOCK, start + end - position)
+            tasks.append((self.entropy, block, start, stop, self.base))
+            position += stop - start
+
+        if self.workers > 1 and len(tasks) > 1:
+            if self.executor is None:
+                self.executor = futures.ProcessPoolExecutor(max_workers=self.workers)
+            blocks = list(self.executor.map(_draw_block, *zip(*tasks)))
+        else:
+            blocks = [_draw_block(*task) for task in tasks]
+        self.position = end
+        return np.concatenate(blocks)
+
+    def _counter_values(self, start, count):
+        # The permutation works on packed values directly
+        if start < 0 or start + count > self.base ** ID_LENGTH:
+            raise ValueError(f"Positions must lie between 0 and {self.base ** ID_LENGTH:,}")
+        return _permute(np.arange(start, start + count, dtype=np.uint64), self.round_keys, self.base)
+
+    def _fresh_mask(self, packed):
+        # First occurrence of each value within the batch that was never issued before
+        order = np.argsort(packed)
+        ordered = packed[order]
+        keep = np.ones(len(packed), dtype=bool)
+        keep[1:] = ordered[1:] != ordered[:-1]
+        if not keep.all():
+            # Rare: only a stable sort guarantees the earliest duplicate survives
+            order = np.argsort(packed, kind="stable")
+            ordered = packed[order]
+        keep &= ~self.index.contains(ordered)
+        if self.registry is not None:
+            keep &= ~self.registry.contains(ordered)
+        mask = np.empty_like(keep)
+        mask[order] = keep
+        return mask
+
+    def _make_unique(self, packed):
+        if self.registry is None:
+            packed = self._drop_issued(packed)
+            self.index.add(packed)
+            return packed
+        # Checked and recorded under one registry lock, so a process sharing the
+        # registry cannot accept the same ID in between. The registry covers this run
+        # as well, so long-lived processes such as the ID service do not also keep
+        # every issued ID in memory.
+        with self.registry.lock():
+            packed = self._drop_issued(packed)
+            self.registry.add(packed)
+        return packed
+
+    def _register_counter_values(self, packed, start):
+        with self.registry.lock():
+            issued = np.flatnonzero(self.registry.contains(packed))
+            if len(issued):
+                raise ValueError(f"{len(issued)} IDs from position {start + int(issued[0]):,} on were already "
+                                 f"issued according to the ID registry")
+            self.registry.add(packed)
+
+    def _drop_issued(self, packed):
+        count = len(packed)
+        while True:
+            packed = packed[self._fresh_mask(packed)]
+            missing = count - len(packed)
+            if not missing:
+                return packed
+            # Redraw only the colliding IDs from the same stream, which continues where
+            # the batch stopped; so the result is that stream minus duplicates however
+            # the run is split into calls. Accepted rows stay first occurrences.
+            draw = self._draw_parallel_indices if self.parallel else self._draw_indices
+            packed = np.concatenate([packed, pack_indices(draw(missing))])
+
+    def generate_packed(self, count, start_counter=0):
+        # IDs as a uint64 array (8 bytes per ID), ready to sort, deduplicate or join
+        # on without creating strings; decode_ids() turns them into text.
+        # start_counter is the run position of the first ID; only counter mode can
+        # jump to it, the random modes always continue their stream
         if self.rng is None:
             self.set_seed(self.seed)
 
-        ids = []
-        for _ in range(count):
-            id_chars = [
-                self._index_to_char(self.rng.integers(0, self.base))
-                for _ in range(9)
-            ]
-            ids.append(''.join(id_chars))
-        return ids
+        chunks = []
+        for offset in range(0, count, GENERATION_CHUNK):
+            chunk = min(GENERATION_CHUNK, count - offset)
+            if self.counter:
+                packed = self._counter_values(start_counter + offset, chunk)
+                if self.registry is not None:
+                    self._register_counter_values(packed, start_counter + offset)
+                chunks.append(packed)
+                continue
+            if self.parallel:
+                packed = pack_indices(self._draw_parallel_indices(chunk))
+            else:
+                packed = pack_indices(self._draw_indices(chunk))
+            if self.unique or self.registry is not None:
+                packed = self._make_unique(packed)
+            chunks.append(packed)
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.uint64)
+
+    def generate_ids(self, count, start_counter=0):
+        # Same IDs as generate_packed, as a list of str
+        return decode_ids(self.generate_packed(count, start_counter), self.check)
 
     def generate_one_id(self, existing_ids):
         raise NotImplementedError("generate_one_id is deprecated. Use generate_ids instead.")
 
-    def save_ids(self, ids, dest_path, file_type):
+    def _output_path(self, dest_path, file_type, suffix=""):
+        # A name no other output has, reserved by creating its ".part" file; runs
+        # started in the same second get "_2", "_3", ... appended
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"generated_ids_{timestamp}{file_type}"
-        output_path = os.path.join(dest_path, filename)
+        number = 1
+        while True:
+            name = f"generated_ids_{timestamp}" if number == 1 else f"generated_ids_{timestamp}_{number}"
+            output_path = os.path.join(dest_path, f"{name}{file_type}{suffix}")
+            number += 1
+            if os.path.exists(output_path):
+                continue
+            try:
+                os.close(os.open(output_path + ".part", os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            except FileExistsError:
+                continue
+            return output_path
 
+    def open_writer(self, dest_path, file_type, public_keys=None, compression=None):
+        # Streaming counterpart of save_ids: write() each batch as it is generated,
+        # then close() on success or abort() on cancel. With compression and/or
+        # public_keys the output is "<name><ext>[.gz|.zst][.c4gh]", compressed and
+        # encrypted as it is written.
+        check_writer_options(file_type, public_keys, compression)
         try:
-            if file_type == ".csv":
-                with open(output_path, 'w', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(["ehealth_id"])
-                    for id in ids:
-                        writer.writerow([id])
-            elif file_type == ".txt":
-                with open(output_path, 'w') as f:
-                    f.write("\n".join(ids))
-            elif file_type == ".json":
-                with open(output_path, 'w') as f:
-                    json.dump({"ids": ids}, f, indent=4)
-            elif file_type == ".xlsx":
-                if Workbook is None:
-                    raise ImportError("The 'openpyxl' library is required to save as .xlsx.")
-                wb = Workbook()
-                ws = wb.active
-                ws.title = "Generated IDs"
-                ws.append(["ID"])
-                for id in ids:
-                    ws.append([id])
-                wb.save(output_path)
-            return output_path
+            output_path = self._output_path(dest_path, file_type, writer_suffix(public_keys, compression))
+            return WRITERS[file_type](output_path, public_keys=public_keys, check=self.check,
+                                      compression=compression)
         except Exception as e:
-            raise Exception(f"Error saving IDs: {str(e)}")
+            raise SaveError(f"Error saving IDs: {str(e)}")
+
+    def save_ids(self, ids, dest_path, file_type):
+        output_path = self._output_path(dest_path, file_type)
+        writer = None
+        try:
+            if file_type not in WRITERS:
+                raise ValueError(f"Unsupported file type: {file_type}")
+            writer = WRITERS[file_type](output_path, check=self.check)
+            writer.write(ids)
+            return writer.close()
+        except Exception as e:
+            if writer is not None and os.path.exists(writer.temp_path):
+                os.remove(writer.temp_path)
+            raise SaveError(f"Error saving IDs: {str(e)}")
+
+
+def writer_suffix(public_keys=None, compression=None):
+    # What compression and encryption add to a writer's file name, in that order
+    return (COMPRESSION_SUFFIXES[compression] if compression else "") + \
+        (crypto.ENCRYPTED_EXTENSION if public_keys else "")
+
+
+def check_writer_options(file_type, public_keys=None, compression=None):
+    if file_type not in WRITERS:
+        raise ValueError(f"Unsupported file type: {file_type}")
+    if public_keys and not WRITERS[file_type].encryptable:
+        raise ValueError(f"{file_type} files cannot be encrypted while they are written")
+    if compression and compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unsupported compression: {compression}")
+    if compression and not WRITERS[file_type].compressible:
+        raise ValueError(f"{file_type} files are compressed by the format itself")
+
+
+def _compressor(target, compression):
+    # Streaming compressor writing to target, which it leaves open when closed
+    if compression == "gzip":
+        # No name and no timestamp in the header, so equal IDs give equal files
+        return gzip.GzipFile(filename="", fileobj=target, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The 'zstandard' library is required for zstd compression.")
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(target, closefd=False)
+
+
+def _decompressor(path, compression):
+    # Binary file object reading the decompressed content of a file written by _compressor
+    if compression == "gzip":
+        return gzip.open(path, 'rb')
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("The 'zstandard' library is required for zstd compression.")
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+
+def _rename_new(source, target):
+    # os.replace that never overwrites: raises FileExistsError if target exists
+    if os.name == "nt":
+        os.rename(source, target)  # Fails if target exists
+        return
+    try:
+        os.link(source, target)  # Fails if target exists
+    except FileExistsError:
+        raise
+    except OSError:
+        # No hard links on this filesystem (FAT/exFAT, some SMB shares)
+        if os.path.exists(target):
+            raise FileExistsError(f"{target} already exists")
+        os.replace(source, target)
+        return
+    os.remove(source)
+
+
+class IdWriter:
+    # Appends IDs batch by batch to "<name>.part", so memory does not grow with the
+    # number of IDs. close() renames the file to its final name; abort() flushes what
+    # was written and renames it to "<name>_incomplete<ext>" instead. Given an open
+    # stream (such as stdout) instead of a path, it writes there and leaves it open.
+    # Given public_keys, everything goes through a Crypt4GHWriter on its way to the
+    # file or stream (which must then be binary), so no plaintext ever reaches disk.
+    # compression ("gzip" or "zstd") compresses the output on the way, before any
+    # encryption. With check=True, IDs are written with their check character.
+    binary = False
+    newline = None
+    packed = False  # _write() gets a uint64 array instead of a list of str
+    encryptable = True  # Can be written through a Crypt4GHWriter
+    compressible = True  # Can be written through gzip or zstd
+
+    def __init__(self, output_path=None, stream=None, public_keys=None, check=False, compression=None):
+        self.output_path = output_path
+        self.temp_path = output_path + ".part" if output_path else None
+        self.stream = stream
+        self.public_keys = public_keys or None
+        self.check = check
+        self.compression = compression or None
+        self.layers = []
+        self.count = 0
+        self._open()
+
+    def _open_file(self):
+        if self.public_keys is None and self.compression is None:
+            if self.stream is not None:
+                return self.stream
+            if self.binary:
+                return open(self.temp_path, 'wb')
+            return open(self.temp_path, 'w', newline=self.newline)
+
+        # file or stream -> [encryption] -> [compression] -> [text]; _close_file
+        # closes them outermost first, which flushes each into the next
+        sink = self.stream
+        if sink is None:
+            sink = open(self.temp_path, 'wb')
+            self.layers.append(sink)
+        if self.public_keys is not None:
+            sink = crypto.Crypt4GHWriter(sink, self.public_keys, close_target=False)
+            self.layers.append(sink)
+        if self.compression is not None:
+            sink = _compressor(sink, self.compression)
+            self.layers.append(sink)
+        if not self.binary:
+            sink = io.TextIOWrapper(sink, encoding="utf-8", newline=self.newline)
+            self.layers.append(sink)
+        return sink
+
+    def _close_file(self):
+        # Closing the encryptor writes its last segment; a stream itself stays open
+        if not self.layers:
+            if self.stream is not None:
+                self.file.flush()
+            else:
+                self.file.close()
+            return
+        for layer in reversed(self.layers):
+            layer.close()
+        if self.stream is not None:
+            self.stream.flush()
+
+    def write(self, ids):
+        # Accepts a list of str or a packed uint64 array, converted here one batch at a
+        # time to what the format works with
+        if len(ids):
+            if self.packed:
+                ids = encode_ids(ids)
+            elif isinstance(ids, np.ndarray):
+                ids = decode_ids(ids, self.check)
+            self._write(ids)
+            self.count += len(ids)
+
+    def close(self):
+        self._finish(complete=True)
+        if self.stream is None:
+            _rename_new(self.temp_path, self.output_path)
+        return self.output_path
+
+    def abort(self):
+        self._finish(complete=False)
+        if self.stream is not None:
+            return None
+        # What was written before the abort is still a valid (compressed, encrypted) file
+        suffix = writer_suffix(self.public_keys, self.compression)
+        root, ext = os.path.splitext(self.output_path[:len(self.output_path) - len(suffix)])
+        number = 1
+        while True:
+            incomplete_path = f"{root}_incomplete{ext}{suffix}" if number == 1 else \
+                f"{root}_incomplete_{number}{ext}{suffix}"
+            try:
+                _rename_new(self.temp_path, incomplete_path)
+                return incomplete_path
+            except FileExistsError:
+                number += 1
+
+
+class CsvIdWriter(IdWriter):
+    newline = ''
+
+    def _open(self):
+        self.file = self._open_file()
+        csv.writer(self.file).writerow(["ehealth_id"])
+
+    def _write(self, ids):
+        # IDs never need quoting, so this matches csv.writer's "\r\n" rows
+        self.file.write("\r\n".join(ids) + "\r\n")
+
+    def _finish(self, complete):
+        self._close_file()
+
+
+class TxtIdWriter(IdWriter):
+    def _open(self):
+        self.file = self._open_file()
+
+    def _write(self, ids):
+        # One ID per line without a trailing newline, as save_ids writes it
+        self.file.write(("\n" if self.count else "") + "\n".join(ids))
+
+    def _finish(self, complete):
+        if self.stream is not None and self.count:
+            # Ends the last line in pipelines, where "read" and "wc -l" need it
+            self.file.write("\n")
+        self._close_file()
+
+
+class JsonIdWriter(IdWriter):
+    # Writes the same layout as json.dump({"ids": ids}, f, indent=4); an aborted file
+    # is still valid JSON and carries "complete": false
+    def _open(self):
+        self.file = self._open_file()
+        self.file.write('{\n    "ids": [')
+
+    def _write(self, ids):
+        prefix = ",\n        " if self.count else "\n        "
+        self.file.write(prefix + ",\n        ".join(json.dumps(id) for id in ids))
+
+    def _finish(self, complete):
+        self.file.write("\n    ]" if self.count else "]")
+        if not complete:
+            self.file.write(',\n    "complete": false')
+        # Files match json.dump; on a stream the last line is ended for pipelines
+        self.file.write("\n}\n" if self.stream is not None else "\n}")
+        self._close_file()
+
+
+class XlsxIdWriter(IdWriter):
+    # Write-only mode streams rows to a temporary file instead of keeping a cell
+    # object per ID. A sheet holds at most EXCEL_MAX_ROWS rows, so once one is full
+    # the writer rolls over to "Generated IDs (2)", "Generated IDs (3)", ...
+    # Those temporary files hold the IDs in plaintext, so .xlsx is never encrypted.
+    binary = True
+    encryptable = False
+    compressible = False  # Already a zip file
+
+    def _open(self):
+        # For .xlsx support; openpyxl is only imported when this format is chosen
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise ImportError("The 'openpyxl' library is required to save as .xlsx.")
+        self.workbook = Workbook(write_only=True)
+        self.sheets = 0
+        self._add_sheet()
+
+    def _add_sheet(self):
+        self.sheets += 1
+        title = "Generated IDs" if self.sheets == 1 else f"Generated IDs ({self.sheets})"
+        self.sheet = self.workbook.create_sheet(title)
+        self.sheet.append(["ID"])
+        self.sheet_free = EXCEL_MAX_ROWS - 1
+
+    def _write(self, ids):
+        start = 0
+        while start < len(ids):
+            if not self.sheet_free:
+                self._add_sheet()
+            stop = start + min(self.sheet_free, len(ids) - start)
+            append = self.sheet.append
+            for index in range(start, stop):
+                append([ids[index]])
+            self.sheet_free -= stop - start
+            start = stop
+
+    def _finish(self, complete):
+        self.workbook.save(self.stream if self.stream is not None else self.temp_path)
+
+
+class ParquetIdWriter(IdWriter):
+    # One "ehealth_id" string column, one row group per batch
+    binary = True
+    packed = True
+    compressible = False  # Compressed by Parquet itself, per column
+
+    def _open(self):
+        # For .parquet support; pyarrow is only imported when this format is chosen
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The 'pyarrow' library is required to save as .parquet.")
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([("ehealth_id", pyarrow.string())])
+        # The footer is written last, so a forward-only sink such as the encryptor is enough
+        self.sink = self._open_file() if self.public_keys is not None else None
+        where = self.sink or (self.stream if self.stream is not None else self.temp_path)
+        self.file = pyarrow.parquet.ParquetWriter(where, self.schema)
+
+    def _write(self, packed):
+        # Build the string column from the ID bytes directly instead of from Python str
+        pa = self.pyarrow
+        indices = unpack_indices(packed)
+        if self.check:
+            indices = np.column_stack((indices, check_indices(indices)))
+        data = np.ascontiguousarray(_codec_tables()[0][indices])
+        width = indices.shape[1]
+        offsets = np.arange(0, (len(packed) + 1) * width, width, dtype=np.int32)
+        column = pa.StringArray.from_buffers(len(packed), pa.py_buffer(offsets), pa.py_buffer(data))
+        self.file.write_batch(pa.record_batch([column], schema=self.schema))
+
+    def _finish(self, complete):
+        self.file.close()
+        if self.sink is not None:
+            self._close_file()  # The encryptor and the file under it, after the footer
+
+
+class BinaryIdWriter(IdWriter):
+    # Fixed-width .ehid files, read back with BinaryIdReader
+    binary = True
+    packed = True
+
+    def _open(self):
+        self.file = self._open_file()
+        self.file.write(EHID_HEADER.pack(EHID_MAGIC, EHID_VERSION, 8, CHECK_LENGTH if self.check else ID_LENGTH))
+
+    def _write(self, packed):
+        self.file.write(packed.astype("<u8", copy=False).tobytes())
+
+    def _finish(self, complete):
+        self._close_file()
+
+
+def _ehid_id_length(header, path):
+    # ID length recorded in an .ehid header, after checking that this reader can read it
+    if len(header) < EHID_HEADER.size or header[:4] != EHID_MAGIC:
+        raise ValueError(f"{path} is not an .ehid file")
+    _, version, record_size, id_length = EHID_HEADER.unpack(header[:EHID_HEADER.size])
+    if version != EHID_VERSION or record_size != 8 or id_length not in (ID_LENGTH, CHECK_LENGTH):
+        raise ValueError(f"Unsupported .ehid file (version {version}, {record_size}-byte records)")
+    return id_length
+
+
+class BinaryIdReader:
+    # Memory-mapped view of an .ehid file: opening costs the same whatever the size,
+    # reader[n] decodes only ID number n and reader.packed is the whole file as a
+    # zero-copy uint64 array. IDs come out with a check character if they were written
+    # with one.
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(EHID_HEADER.size)
+        id_length = _ehid_id_length(header, path)
+        count = (os.path.getsize(path) - EHID_HEADER.size) // 8
+        self.path = path
+        self.check = id_length == CHECK_LENGTH
+        if count:
+            self.packed = np.memmap(path, dtype="<u8", mode="r", offset=EHID_HEADER.size, shape=(count,))
+        else:
+            self.packed = np.empty(0, dtype=np.uint64)  # mmap cannot map zero bytes
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return decode_ids(self.packed[n], self.check)
+        if not -len(self) <= n < len(self):
+            raise IndexError(f"ID number {n} is out of range for {len(self)} IDs")
+        return decode_ids([self.packed[n]], self.check)[0]
+
+    def close(self):
+        self.packed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+WRITERS = {
+    ".csv": CsvIdWriter,
+    ".txt": TxtIdWriter,
+    ".json": JsonIdWriter,
+    ".xlsx": XlsxIdWriter,
+    ".parquet": ParquetIdWriter,
+    ".ehid": BinaryIdWriter,
+}
+
+
+def _arrow_ids(array):
+    # An Arrow string column as a fixed-width bytes array. When every ID has the same
+    # length (the usual case), the column's data buffer is already that array and no
+    # per-ID object is created; otherwise go through Python str.
+    if len(array) and not array.null_count:
+        _, offsets, data = array.buffers()
+        offsets = np.frombuffer(offsets, dtype=np.int32, count=len(array) + 1, offset=array.offset * 4)
+        width = int(offsets[1] - offsets[0])
+        if 0 < width <= ID_LENGTH + 2 and offsets[-1] - offsets[0] == width * len(array):
+            lengths = np.diff(offsets)
+            if (lengths == width).all():
+                return np.frombuffer(data, dtype=f"S{width}", count=len(array), offset=int(offsets[0]))
+    return array.to_numpy(zero_copy_only=False)
+
+
+def read_ids(path):
+    # The IDs of a file in any of the WRITERS formats, in file order: a packed uint64
+    # array for .ehid, text (list or array of str) for everything else. The readers
+    # load whole columns at once so validate_ids can check them in one go. Files
+    # written with compression ("<name><ext>.gz" or ".zst") are decompressed on the way.
+    compression = next((method for method, suffix in COMPRESSION_SUFFIXES.items()
+                        if path.lower().endswith(suffix)), None)
+    file_type = os.path.splitext(path[:-len(COMPRESSION_SUFFIXES[compression])] if compression else path)[1].lower()
+    if compression and (file_type not in WRITERS or not WRITERS[file_type].compressible):
+        raise ValueError(f"Unsupported file type: {file_type}{COMPRESSION_SUFFIXES[compression]}")
+
+    def open_file():
+        return _decompressor(path, compression) if compression else open(path, 'rb')
+
+    if file_type == ".ehid":
+        if not compression:
+            return np.array(BinaryIdReader(path).packed)
+        with open_file() as f:
+            data = f.read()
+        _ehid_id_length(data, path)
+        count = (len(data) - EHID_HEADER.size) // 8
+        return np.frombuffer(data, dtype="<u8", count=count, offset=EHID_HEADER.size).astype(np.uint64)
+    if file_type == ".txt":
+        with open_file() as f:
+            lines = f.read().replace(b"\r\n", b"\n").split(b"\n")
+        if lines and not lines[-1]:
+            lines.pop()  # Trailing newline
+        return lines
+    if file_type == ".json":
+        with open_file() as f:
+            return json.load(f)["ids"]
+    if file_type in (".csv", ".parquet"):
+        try:
+            import pyarrow
+            import pyarrow.csv
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(f"The 'pyarrow' library is required to read {file_type} files.")
+        if file_type == ".csv":
+            options = pyarrow.csv.ConvertOptions(include_columns=["ehealth_id"],
+                                                 column_types={"ehealth_id": pyarrow.string()},
+                                                 strings_can_be_null=False)
+            with open_file() as f:
+                column = pyarrow.csv.read_csv(f, convert_options=options).column("ehealth_id")
+        else:
+            column = pyarrow.parquet.read_table(path, columns=["ehealth_id"]).column("ehealth_id")
+        return _arrow_ids(column.combine_chunks().cast(pyarrow.string()))
+    if file_type == ".xlsx":
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ImportError("The 'openpyxl' library is required to read .xlsx files.")
+        workbook = load_workbook(path, read_only=True)
+        try:
+            # Every sheet starts with the "ID" header row
+            return ["" if value is None else str(value)
+                    for sheet in workbook.worksheets
+                    for (value,) in sheet.iter_rows(min_row=2, max_col=1, values_only=True)]
+        finally:
+            workbook.close()
+    raise ValueError(f"Unsupported file type: {file_type}")
@@ -0,0 +1,269 @@
+import json
+import os
+import secrets
+from lazy import lazy_import
+from model import Model, decode_ids
+from registry import REGISTRY_DIRNAME
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+sqlite3 = lazy_import("sqlite3")
+
+# Replaces identifier columns of a CSV or Parquet dataset with eHealth IDs. Every
+# source identifier ever seen is kept in a mapping table (SQLite) together with its
+# pseudonym, so the same identifier always gets the same eHealth ID, in this file and
+# in every later run against the same table. The dataset is read PSEUDONYMIZE_CHUNK
+# rows at a time, so memory stays flat however large the file is.
+
+# Rows read, mapped and written per step
+PSEUDONYMIZE_CHUNK = 250_000
+
+# Hashes looked up per query
+LOOKUP_BATCH = 100_000
+
+PSEUDONYMIZED_SUFFIX = "_pseudonymized"
+SUPPORTED_EXTENSIONS = (".csv", ".parquet")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS pseudonyms (
+    hash INTEGER PRIMARY KEY,  -- Keyed 64-bit hash of the source identifier, or the next free slot after it
+    source TEXT NOT NULL,      -- The source identifier itself, compared on every lookup
+    pseudonym INTEGER NOT NULL -- Packed eHealth ID, unique through the ID registry
+);
+"""
+
+# WAL keeps readers and the writer out of each other's way; a crash can lose at most
+# the last chunk's new pseudonyms, never corrupt the table
+PRAGMAS = ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL", "PRAGMA cache_size=-65536")
+
+
+def pseudonymized_output_path(file_path):
+    root, ext = os.path.splitext(file_path)
+    return f"{root}{PSEUDONYMIZED_SUFFIX}{ext}"
+
+
+def next_slot(slots):
+    # Linear probing: the slot after each one, wrapping around the int64 range
+    return (np.asarray(slots, dtype=np.int64).view(np.uint64) + np.uint64(1)).view(np.int64)
+
+
+def hash_sources(sources, hash_key):
+    # Keyed 64-bit hashes of source identifiers (str), as the int64 values SQLite stores
+    hashes = pd.util.hash_array(np.asarray(sources, dtype=object), encoding="utf8", hash_key=hash_key,
+                                categorize=False)
+    return hashes.view(np.int64)
+
+
+class PseudonymMap:
+    # The persistent mapping table. Source identifiers are located by a 64-bit
+    # pandas.util.hash_array hash (one vectorized call per chunk) under a random key
+    # stored with the table; the table's integer primary key is that hash, so each
+    # chunk is resolved with one indexed query instead of a text comparison per
+    # row. Two identifiers with the same hash are told apart by the stored source:
+    # the later one takes the next free slot (linear probing), so a collision only
+    # costs a few extra lookups for that identifier. New pseudonyms come from a Model
+    # with the ID registry of the mapping's directory, so they never repeat IDs
+    # issued there before.
+    def __init__(self, path, registry_path=None):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        for pragma in PRAGMAS:
+            self.connection.execute(pragma)
+        self.connection.executescript(SCHEMA)
+        # 16 characters (hash_array's key size) carrying 96 random bits; tables
+        # created with an older, shorter key keep it
+        self.hash_key = self._meta("hash_key", lambda: secrets.token_urlsafe(12))
+        self.model = Model()
+        self.model.set_seed("")  # Pseudonyms must not be derivable from anything
+        self.model.set_unique(True)
+        self.model.open_registry(registry_path or os.path.join(os.path.dirname(os.path.abspath(path)),
+                                                               REGISTRY_DIRNAME))
+        self.created = 0
+
+    def _meta(self, key, default):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return row[0]
+        self.connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, default()))
+        return self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM pseudonyms").fetchone()[0]
+
+    def packed(self, sources):
+        # Packed pseudonyms for an array of distinct source identifiers (str), adding
+        # the ones not seen before. One transaction per call, so concurrent runs
+        # against the same table never hand out two pseudonyms for one identifier.
+        sources = np.asarray(sources, dtype=object)
+        slots = hash_sources(sources, self.hash_key)
+        pseudonyms = np.zeros(len(sources), dtype=np.uint64)
+        found = np.zeros(len(sources), dtype=bool)
+        collided = np.zeros(len(sources), dtype=bool)  # Slot taken by another identifier
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for start in range(0, len(sources), LOOKUP_BATCH):
+                stop = min(start + LOOKUP_BATCH, len(sources))
+                # The whole batch goes in as one JSON parameter instead of a row per hash
+                rows = cursor.execute("SELECT hash, source, pseudonym FROM pseudonyms WHERE hash IN "
+                                      "(SELECT value FROM json_each(?))",
+                                      (json.dumps(slots[start:stop].tolist()),)).fetchall()
+                if not rows:
+                    continue
+                row_hashes, row_sources, row_pseudonyms = (np.array(values) for values in zip(*rows))
+                order = np.argsort(row_hashes)
+                positions = np.searchsorted(row_hashes[order], slots[start:stop])
+                positions[positions == len(rows)] = 0
+                matches = order[positions]
+                hit = np.flatnonzero(row_hashes[matches] == slots[start:stop])
+                same = row_sources.astype(object)[matches[hit]] == sources[start:stop][hit]
+                pseudonyms[start:stop][hit[same]] = row_pseudonyms[matches[hit[same]]]
+                found[start:stop][hit[same]] = True
+                collided[start:stop][hit[~same]] = True
+
+            # New identifiers whose slot another new one in this call already claims
+            new = np.flatnonzero(~found & ~collided)
+            new = new[np.argsort(slots[new], kind="stable")]
+            repeated = np.zeros(len(new), dtype=bool)
+            repeated[1:] = slots[new][1:] == slots[new][:-1]
+            collided[new[repeated]] = True
+            claimed = set(slots[new[~repeated]].tolist())
+            for position in np.flatnonzero(collided).tolist():
+                self._probe(cursor, position, sources, slots, pseudonyms, found, claimed)
+
+            missing = np.flatnonzero(~found)
+            if len(missing):
+                missing = missing[np.argsort(slots[missing])]  # Inserted in key order
+                pseudonyms[missing] = self.model.generate_packed(len(missing))
+                cursor.executemany("INSERT INTO pseudonyms (hash, source, pseudonym) VALUES (?, ?, ?)",
+                                   zip(slots[missing].tolist(), sources[missing].tolist(),
+                                       pseudonyms[missing].astype(np.int64).tolist()))
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        self.created += len(missing)
+        return pseudonyms
+
+    def _probe(self, cursor, position, sources, slots, pseudonyms, found, claimed):
+        # Rare path for one identifier whose hash slot holds a different one: walk the
+        # following slots until its own row or a free slot turns up
+        slot = int(slots[position])
+        while True:
+            slot = int(next_slot(slot))
+            if slot in claimed:
+                continue
+            row = cursor.execute("SELECT source, pseudonym FROM pseudonyms WHERE hash = ?", (slot,)).fetchone()
+            if row is None:
+                claimed.add(slot)
+                slots[position] = slot
+                return
+            if row[0] == sources[position]:
+                slots[position] = slot
+                pseudonyms[position] = np.int64(row[1]).astype(np.uint64)
+                found[position] = True
+                return
+
+    def map(self, values):
+        # Vectorized replacement of a column: each distinct value is looked up once.
+        # Missing values (None/NaN) and empty strings are left as they are.
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=True)
+        uniques = np.asarray(uniques, dtype=object)
+        keep = uniques != ""
+        result = np.full(len(uniques) + 1, None, dtype=object)  # The extra slot is for missing values
+        result[np.flatnonzero(~keep)] = ""
+        if keep.any():
+            result[np.flatnonzero(keep)] = decode_ids(self.packed(uniques[keep]))
+        return result[np.where(codes < 0, len(uniques), codes)]
+
+    def close(self):
+        self.model.close_registry()
+        self.connection.close()
+
+
+def _csv_chunks(path, columns, chunk_size):
+    # Everything is read as text, so other columns come out exactly as they went in
+    # ("007" stays "007", "NA" stays "NA") and "00123" is a different identifier than "123"
+    reader = pd.read_csv(path, dtype=str, keep_default_na=False,
+                         na_values={column: [""] for column in columns}, chunksize=chunk_size)
+    with reader:
+        yield from reader
+
+
+def _pseudonymize_csv(input_path, temp_path, columns, mapping, chunk_size, progress):
+    header = pd.read_csv(input_path, nrows=0).columns
+    _check_columns(header, columns)
+    rows = 0
+    with open(temp_path, 'w', newline='') as f:
+        for chunk in _csv_chunks(input_path, columns, chunk_size):
+            for column in columns:
+                chunk[column] = mapping.map(chunk[column].to_numpy(dtype=object))
+            chunk.to_csv(f, header=f.tell() == 0, index=False)
+            rows += len(chunk)
+            if progress is not None:
+                progress(rows)
+        if f.tell() == 0:
+            pd.DataFrame(columns=header).to_csv(f, index=False)  # No data rows
+    return rows
+
+
+def _pseudonymize_parquet(input_path, temp_path, columns, mapping, chunk_size, progress):
+    # Works on Arrow record batches, so every column that is not replaced keeps its
+    # exact type; only the identifier columns go through pandas and become strings
+    import pyarrow
+    import pyarrow.parquet
+
+    source = pyarrow.parquet.ParquetFile(input_path)
+    _check_columns(source.schema_arrow.names, columns)
+    schema = source.schema_arrow
+    for column in columns:
+        index = schema.get_field_index(column)
+        schema = schema.set(index, pyarrow.field(column, pyarrow.string()))
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(temp_path, schema) as writer:
+        for batch in source.iter_batches(batch_size=chunk_size):
+            arrays = list(batch.columns)
+            for column in columns:
+                index = batch.schema.get_field_index(column)
+                values = arrays[index].cast(pyarrow.string()).to_numpy(zero_copy_only=False)
+                arrays[index] = pyarrow.array(mapping.map(values), type=pyarrow.string())
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+            rows += batch.num_rows
+            if progress is not None:
+                progress(rows)
+    return rows
+
+
+def _check_columns(available, columns):
+    missing = [column for column in columns if column not in set(available)]
+    if missing:
+        raise ValueError(f"Column(s) not found in the dataset: {', '.join(missing)}")
+
+
+def pseudonymize_file(input_path, output_path, columns, mapping_path, chunk_size=PSEUDONYMIZE_CHUNK,
+                      progress=None, registry_path=None):
+    # Writes "<output>.part" and renames it when done; progress(rows) is called after
+    # every chunk. Returns (rows, new_pseudonyms). Pseudonyms handed out before a
+    # failure stay in the mapping table, which is harmless.
+    ext = os.path.splitext(input_path)[1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise ValueError(f"Unsupported dataset type: {ext or input_path} (use {' or '.join(SUPPORTED_EXTENSIONS)})")
+    if not columns:
+        raise ValueError("No identifier columns given")
+    if os.path.abspath(input_path) == os.path.abspath(output_path):
+        raise ValueError("The output must not overwrite the input dataset")
+
+    process = _pseudonymize_csv if ext == ".csv" else _pseudonymize_parquet
+    temp_path = output_path + ".part"
+    mapping = PseudonymMap(mapping_path, registry_path)
+    try:
+        rows = process(input_path, temp_path, list(dict.fromkeys(columns)), mapping, chunk_size, progress)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        mapping.close()
+    return rows, mapping.created
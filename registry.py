@@ -0,0 +1,193 @@
+import contextlib
+import os
+import threading
+import uuid
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+REGISTRY_DIRNAME = ".ehealth_registry"
+LOCK_NAME = "lock"
+
+# Marks a run that a merge has superseded but that could not be removed yet
+MERGED_SUFFIX = ".merged"
+
+# Values handled per step when merging runs on disk (~16 MB of uint64)
+MERGE_CHUNK = 2_000_000
+
+
+class IdRegistry:
+    # Persistent set of issued IDs (packed uint64). Every batch of inserts is written
+    # as its own sorted run file and runs are merged geometrically, like the in-memory
+    # IssuedIndex, so a registry never has more than ~log2(n) files. Runs are opened
+    # with np.memmap: opening costs a few syscalls whatever the size, and lookups are a
+    # binary search per run that only touches the pages it needs.
+    #
+    # Several processes may share a registry (the GUI, cli.py and the ID service all
+    # default to the same directory). Every read and write happens under an exclusive
+    # lock on the registry's lock file, after picking up the runs other processes
+    # have written or merged since; callers that check and then add IDs hold lock()
+    # around both, so no two processes can accept the same ID.
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.runs = []
+        self.lock_file = None
+        self.lock_depth = 0
+        self.thread_lock = threading.RLock()  # The ID service reads it from another thread
+        with self.lock():
+            pass
+
+    def __len__(self):
+        with self.lock():
+            return sum(len(run) for _, run in self.runs)
+
+    @contextlib.contextmanager
+    def lock(self):
+        # Re-entrant within the thread that holds it; other threads of this process
+        # wait on thread_lock, other processes on the lock file. The directory is
+        # re-scanned on every outermost acquisition.
+        with self.thread_lock:
+            if self.lock_depth == 0:
+                self.lock_file = open(os.path.join(self.path, LOCK_NAME), "a+b")
+                try:
+                    _lock(self.lock_file)
+                    self._refresh()
+                except BaseException:
+                    self.lock_file.close()
+                    self.lock_file = None
+                    raise
+            self.lock_depth += 1
+            try:
+                yield self
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    _unlock(self.lock_file)
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    def _refresh(self):
+        # Runs currently on disk, in creation order; runs already mapped are kept
+        mapped = dict(self.runs)
+        self.runs = []
+        names = set(os.listdir(self.path))
+        for name in sorted(names):
+            if name.startswith("run-") and name.endswith(".u64"):
+                run_path = os.path.join(self.path, name)
+                if name + MERGED_SUFFIX in names:
+                    _remove_merged(run_path)  # Retried until no process maps it any more
+                elif run_path in mapped:
+                    self.runs.append((run_path, mapped[run_path]))
+                elif os.path.getsize(run_path):
+                    self.runs.append((run_path, np.memmap(run_path, dtype="<u8", mode="r")))
+                else:
+                    os.remove(run_path)
+
+    def contains(self, values):
+        values = np.asarray(values, dtype=np.uint64)
+        found = np.zeros(len(values), dtype=bool)
+        with self.lock():
+            for _, run in self.runs:
+                positions = np.searchsorted(run, values)
+                positions[positions == len(run)] = 0
+                found |= run[positions] == values
+        return found
+
+    def add(self, values):
+        run = np.sort(np.asarray(values, dtype=np.uint64))
+        if not len(run):
+            return
+        run = run[np.concatenate(([True], run[1:] != run[:-1]))]
+        with self.lock():
+            run_path = self._write_run([run])
+            self.runs.append((run_path, np.memmap(run_path, dtype="<u8", mode="r")))
+            while len(self.runs) > 1 and len(self.runs[-2][1]) <= len(self.runs[-1][1]):
+                self._merge_last_runs()
+
+    def close(self):
+        self.runs = []
+
+    def _run_name(self):
+        # Sequence first so listing order is creation order; names are only chosen
+        # under the lock, the suffix just guards against leftovers of a crash
+        sequence = int(os.path.basename(self.runs[-1][0])[4:16]) + 1 if self.runs else 0
+        return f"run-{sequence:012d}-{uuid.uuid4().hex[:8]}.u64"
+
+    def _write_run(self, chunks):
+        # Write to a temporary file and rename, so a crash never leaves a partial run
+        run_path = os.path.join(self.path, self._run_name())
+        temp_path = run_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk.astype("<u8", copy=False).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, run_path)
+        return run_path
+
+    def _merge_last_runs(self):
+        (older_path, older), (newer_path, newer) = self.runs[-2], self.runs[-1]
+        merged_path = self._write_run(_merge_sorted(older, newer))
+        self.runs[-2:] = [(merged_path, np.memmap(merged_path, dtype="<u8", mode="r"))]
+        # Until these are removed the merged values exist twice, which is harmless.
+        # On Windows a run that another process still maps cannot be removed; its
+        # marker makes every process skip it, and a later _refresh removes it.
+        del older, newer
+        for path in (older_path, newer_path):
+            open(path + MERGED_SUFFIX, "wb").close()
+            _remove_merged(path)
+
+
+def _remove_merged(run_path):
+    try:
+        os.remove(run_path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return  # Still mapped elsewhere; the marker stays
+    try:
+        os.remove(run_path + MERGED_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def _lock(f):
+    # Blocks until this process holds the registry exclusively
+    if os.name == "nt":
+        import msvcrt
+        while True:
+            f.seek(0)
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # Gives up after ~10 s
+                return
+            except OSError:
+                pass
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock(f):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _merge_sorted(a, b):
+    # Streaming merge of two sorted unique arrays: split on values of the larger array
+    # so each step only holds about MERGE_CHUNK values of each in memory
+    if len(a) < len(b):
+        a, b = b, a
+    b_start = 0
+    for a_start in range(0, len(a), MERGE_CHUNK):
+        a_chunk = np.asarray(a[a_start:a_start + MERGE_CHUNK])
+        last = a_start + MERGE_CHUNK >= len(a)
+        b_end = len(b) if last else int(np.searchsorted(b, a_chunk[-1], side="right"))
+        merged = np.sort(np.concatenate([a_chunk, np.asarray(b[b_start:b_end])]))
+        b_start = b_end
+        yield merged[np.concatenate(([True], merged[1:] != merged[:-1]))]
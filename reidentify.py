@@ -0,0 +1,222 @@
+import getpass
+import json
+import os
+import shutil
+from datetime import datetime
+from lazy import lazy_import
+from model import encode_ids, decode_ids, validate_ids
+from pseudonymize import hash_sources, next_slot
+
+np = lazy_import("numpy")
+sqlite3 = lazy_import("sqlite3")
+
+# Maps eHealth IDs back to the source identifiers they replaced, and back again, for
+# the rare case where someone must be re-contacted. The index is built once from a
+# pseudonymize mapping table into "<mapping>.index/" and then only read through
+# np.memmap: opening it costs a few syscalls whatever its size, and each lookup is a
+# binary search that touches a handful of pages.
+#
+#   pseudonyms.u64  packed eHealth IDs, sorted
+#   offsets.u64     where each one's source identifier starts in sources.bin (n + 1)
+#   sources.bin     the source identifiers, UTF-8, in the same order
+#   hashes.i64      hash slots of the source identifiers, sorted (as in the mapping)
+#   targets.u64     the packed eHealth ID for each slot
+#   index.json      row count and hash key of the mapping it was built from
+
+INDEX_SUFFIX = ".index"
+INDEX_META = "index.json"
+
+# Rows read from the mapping table per step while building
+INDEX_CHUNK = 1_000_000
+
+
+def default_index_path(mapping_path):
+    return mapping_path + INDEX_SUFFIX
+
+
+def _mapping_state(mapping_path):
+    # (rows, hash key) of a mapping table, opened read-only
+    if not os.path.isfile(mapping_path):
+        raise ValueError(f"Mapping table {mapping_path} does not exist")
+    connection = sqlite3.connect(f"file:{mapping_path}?mode=ro", uri=True)
+    try:
+        rows = connection.execute("SELECT COUNT(*) FROM pseudonyms").fetchone()[0]
+        hash_key = connection.execute("SELECT value FROM meta WHERE key = 'hash_key'").fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"{mapping_path} is not a pseudonym mapping table: {str(e)}")
+    finally:
+        connection.close()
+    return rows, hash_key
+
+
+def build_index(mapping_path, index_path=None):
+    # Streams the mapping table into a new index directory and swaps it in when
+    # complete, so readers never see a half-built index. Memory stays at about
+    # INDEX_CHUNK rows; SQLite does the sorting.
+    index_path = index_path or default_index_path(mapping_path)
+    rows, hash_key = _mapping_state(mapping_path)
+    temp_path = index_path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+
+    connection = sqlite3.connect(f"file:{mapping_path}?mode=ro", uri=True)
+    try:
+        count = 0
+        with open(os.path.join(temp_path, "pseudonyms.u64"), 'wb') as pseudonyms, \
+                open(os.path.join(temp_path, "offsets.u64"), 'wb') as offsets, \
+                open(os.path.join(temp_path, "sources.bin"), 'wb') as sources:
+            position = 0
+            offsets.write(np.zeros(1, dtype="<u8").tobytes())
+            cursor = connection.execute("SELECT pseudonym, source FROM pseudonyms ORDER BY pseudonym")
+            while chunk := cursor.fetchmany(INDEX_CHUNK):
+                encoded = [source.encode("utf-8") for _, source in chunk]
+                lengths = np.fromiter((len(source) for source in encoded), dtype=np.uint64, count=len(chunk))
+                pseudonyms.write(np.fromiter((row[0] for row in chunk), dtype="<u8", count=len(chunk)).tobytes())
+                offsets.write((position + np.cumsum(lengths)).astype("<u8").tobytes())
+                sources.write(b"".join(encoded))
+                position += int(lengths.sum())
+                count += len(chunk)
+
+        # The table's primary key is the hash, so this comes out sorted without a sort
+        with open(os.path.join(temp_path, "hashes.i64"), 'wb') as hashes, \
+                open(os.path.join(temp_path, "targets.u64"), 'wb') as targets:
+            cursor = connection.execute("SELECT hash, pseudonym FROM pseudonyms ORDER BY hash")
+            while chunk := cursor.fetchmany(INDEX_CHUNK):
+                pairs = np.array(chunk, dtype=np.int64)
+                hashes.write(pairs[:, 0].astype("<i8").tobytes())
+                targets.write(pairs[:, 1].astype("<u8").tobytes())
+    finally:
+        connection.close()
+
+    with open(os.path.join(temp_path, INDEX_META), 'w') as f:
+        json.dump({"rows": count, "hash_key": hash_key, "mapping": os.path.abspath(mapping_path),
+                   "built": datetime.now().isoformat(timespec="seconds")}, f, indent=4)
+    old_path = index_path + ".old"
+    if os.path.exists(index_path):
+        os.replace(index_path, old_path)
+    os.replace(temp_path, index_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return index_path
+
+
+def _load(path, name, dtype):
+    file_path = os.path.join(path, name)
+    if not os.path.getsize(file_path):
+        return np.zeros(0, dtype=dtype)  # np.memmap cannot map an empty file
+    return np.memmap(file_path, dtype=dtype, mode="r")
+
+
+class ReidentificationIndex:
+    # Read side of the index. Every lookup takes a list and answers with a list in
+    # the same order, None where nothing matches, so a single lookup is a list of one.
+    # Given audit_log, each looked-up eHealth ID is appended to that JSON Lines file
+    # with the time, the user and the reason; source identifiers never go in the log.
+    def __init__(self, path, audit_log=None, reason=None):
+        with open(os.path.join(path, INDEX_META)) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.pseudonyms = _load(path, "pseudonyms.u64", "<u8")
+        self.offsets = _load(path, "offsets.u64", "<u8")
+        self.sources = _load(path, "sources.bin", np.uint8)
+        self.hashes = _load(path, "hashes.i64", "<i8")
+        self.targets = _load(path, "targets.u64", "<u8")
+        self.audit_log = audit_log
+        self.reason = reason
+
+    def __len__(self):
+        return len(self.pseudonyms)
+
+    def is_stale(self, mapping_path):
+        # The mapping only ever grows, so a different row count means new pseudonyms
+        return _mapping_state(mapping_path)[0] != self.meta["rows"]
+
+    @staticmethod
+    def _search(keys, values):
+        # Row of each value in the sorted keys, or -1
+        if not len(keys):
+            return np.full(len(values), -1, dtype=np.int64)
+        positions = np.searchsorted(keys, values)
+        positions[positions == len(keys)] = 0
+        return np.where(keys[positions] == values, positions, -1)
+
+    def _sources(self, rows):
+        # Source identifiers of the given rows (None for -1); slicing a memoryview
+        # avoids creating a memmap object per row
+        hit = np.flatnonzero(rows >= 0)
+        starts = self.offsets[rows[hit]].tolist()
+        ends = self.offsets[rows[hit] + 1].tolist()
+        data = memoryview(self.sources)
+        results = [None] * len(rows)
+        for position, start, end in zip(hit.tolist(), starts, ends):
+            results[position] = str(data[start:end], "utf-8")
+        return results
+
+    def sources_for(self, ids):
+        # eHealth IDs (str) to source identifiers. Malformed IDs (typos, blank lines)
+        # are not found instead of failing the whole lookup; a check character is
+        # accepted row by row.
+        ids = list(ids)
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        if ids:
+            valid = np.ones(len(ids), dtype=bool)
+            valid[np.intersect1d(validate_ids(ids, False), validate_ids(ids, True))] = False
+            positions = np.flatnonzero(valid)
+            if len(positions):
+                rows[positions] = self._search(self.pseudonyms, encode_ids([ids[i] for i in positions.tolist()]))
+        results = self._sources(rows)
+        self._audit("pseudonym-to-source", ids, results)
+        return results
+
+    def pseudonyms_for(self, sources):
+        # Source identifiers (str) to eHealth IDs. Each one is confirmed through the
+        # other direction; when its hash slot holds a different identifier, the next
+        # slots are tried as the mapping table's linear probing placed it.
+        sources = [str(source) for source in sources]
+        slots = hash_sources(sources, self.meta["hash_key"])
+        results = [None] * len(sources)
+        pending = np.arange(len(sources))
+        while len(pending) and len(self.targets):
+            rows = self._search(self.hashes, slots[pending])
+            occupied = rows >= 0
+            pending, rows = pending[occupied], rows[occupied]
+            packed = np.asarray(self.targets[rows], dtype=np.uint64)
+            back = self._sources(self._search(self.pseudonyms, packed))
+            same = np.array([back_source == sources[i] for back_source, i in zip(back, pending.tolist())],
+                            dtype=bool)
+            for i, id in zip(pending[same].tolist(), decode_ids(packed[same])):
+                results[i] = id
+            pending = pending[~same]
+            slots[pending] = next_slot(slots[pending])
+        self._audit("source-to-pseudonym", results, results)
+        return results
+
+    def _audit(self, direction, ids, results):
+        if self.audit_log is None:
+            return
+        entry = {"time": datetime.now().isoformat(timespec="seconds"), "user": getpass.getuser(),
+                 "direction": direction, "reason": self.reason}
+        with open(self.audit_log, 'a') as f:
+            for id, result in zip(ids, results):
+                f.write(json.dumps({**entry, "ehealth_id": id, "found": result is not None}) + "\n")
+
+    def close(self):
+        self.pseudonyms = self.offsets = self.sources = self.hashes = self.targets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_index(mapping_path, index_path=None, audit_log=None, reason=None):
+    # Opens the index of a mapping table, (re)building it first if it is missing or
+    # the mapping has grown since
+    index_path = index_path or default_index_path(mapping_path)
+    if os.path.exists(os.path.join(index_path, INDEX_META)):
+        index = ReidentificationIndex(index_path, audit_log, reason)
+        if not index.is_stale(mapping_path):
+            return index
+        index.close()
+    build_index(mapping_path, index_path)
+    return ReidentificationIndex(index_path, audit_log, reason)
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import stat
+from urllib.parse import parse_qs, urlsplit
+from lazy import lazy_import
+from model import Model, decode_ids
+from registry import REGISTRY_DIRNAME
+
+np = lazy_import("numpy")
+
+# Hands out fresh eHealth IDs to several local clients at once, over HTTP on localhost
+# or on a Unix socket. One Model does all the generating, with its ID registry, so an
+# ID is never issued twice, across clients or restarts. A background task keeps a pool
+# of pre-generated IDs filled, so a single request is answered from memory, and a
+# client can lease a whole block of IDs in one round-trip.
+#
+#   GET /id                 {"id": "..."}
+#   GET /ids?count=N        {"ids": [...]}    (format=txt: one ID per line)
+#   GET /status             pool and issue counters
+#
+# Pooled IDs are recorded in the registry when they are generated, not when they are
+# issued, so IDs still in the pool at shutdown are simply never used.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# IDs kept ready; refilled in the background whenever it drops below half
+POOL_SIZE = 1_000_000
+
+# Largest block one request may lease
+MAX_LEASE = 1_000_000
+
+# Requests larger than this are not HTTP this service understands
+MAX_HEADER_BYTES = 16_384
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class IdService:
+    def __init__(self, registry_path, pool_size=POOL_SIZE, check=False):
+        self.check = check
+        self.model = Model()
+        self.model.set_seed("")  # Never reproducible: a restart must not replay old IDs
+        self.model.set_unique(True)
+        self.model.open_registry(registry_path)
+        self.pool_size = pool_size
+        self.pool = np.zeros(0, dtype=np.uint64)
+        self.position = 0
+        self.issued = 0
+        self.requests = 0
+        self.lock = None  # One generation at a time; Model is not thread-safe
+        self.wanted = None
+        self.refill_task = None
+
+    def available(self):
+        return len(self.pool) - self.position
+
+    async def start(self):
+        self.lock = asyncio.Lock()
+        self.wanted = asyncio.Event()
+        await self._refill()
+        self.refill_task = asyncio.create_task(self._keep_filled())
+
+    async def stop(self):
+        if self.refill_task is not None:
+            self.refill_task.cancel()
+            try:
+                await self.refill_task
+            except asyncio.CancelledError:
+                pass
+        self.model.close_registry()
+
+    async def _generate(self, count):
+        # On a thread, so the event loop keeps answering from the pool meanwhile
+        async with self.lock:
+            return await asyncio.get_running_loop().run_in_executor(None, self.model.generate_packed, count)
+
+    async def _refill(self):
+        missing = self.pool_size - self.available()
+        if missing > 0:
+            fresh = await self._generate(missing)
+            self.pool = np.concatenate((self.pool[self.position:], fresh))
+            self.position = 0
+
+    async def _keep_filled(self):
+        while True:
+            await self.wanted.wait()
+            self.wanted.clear()
+            try:
+                await self._refill()
+            except Exception as e:
+                logger.error(f"Could not refill the ID pool: {str(e)}")
+                await asyncio.sleep(1)
+                self.wanted.set()
+
+    async def lease(self, count):
+        # Packed IDs for one client; from the pool when it holds enough, otherwise
+        # generated for this request alone so the pool stays ready for small ones
+        if count <= self.available():
+            block = self.pool[self.position:self.position + count]
+            self.position += count
+        else:
+            block = await self._generate(count)
+        if self.available() < self.pool_size // 2:
+            self.wanted.set()
+        self.issued += count
+        return block
+
+    def status(self):
+        return {"pool": self.available(), "pool_size": self.pool_size, "issued": self.issued,
+                "requests": self.requests, "registry": len(self.model.registry)}
+
+    async def handle(self, method, target):
+        # (status, content type, body) for one request
+        if method != "GET":
+            return 405, "application/json", {"error": "only GET is supported"}
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if url.path == "/id":
+            return 200, "application/json", {"id": decode_ids(await self.lease(1), self.check)[0]}
+        if url.path == "/ids":
+            try:
+                count = int(query.get("count", ["1"])[0])
+            except ValueError:
+                count = 0
+            if not 1 <= count <= MAX_LEASE:
+                return 400, "application/json", {"error": f"count must be between 1 and {MAX_LEASE}"}
+            ids = decode_ids(await self.lease(count), self.check)
+            if query.get("format", ["json"])[0] == "txt":
+                return 200, "text/plain; charset=utf-8", "\n".join(ids) + "\n"
+            return 200, "application/json", {"ids": ids}
+        if url.path == "/status":
+            return 200, "application/json", self.status()
+        return 404, "application/json", {"error": f"no such endpoint: {url.path}"}
+
+    async def serve_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, so a client can send request after request on one
+        # connection; only what this service needs is parsed
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break  # Client closed the connection
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 400, "application/json", {"error": "request too large"}, False)
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ")
+                except ValueError:
+                    await self._respond(writer, 400, "application/json", {"error": "malformed request"}, False)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, "application/json", {"error": "invalid Content-Length"}, False)
+                    break
+                if length:
+                    await reader.readexactly(length)  # No endpoint takes a body
+                keep_alive = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close")
+
+                self.requests += 1
+                try:
+                    status, content_type, body = await self.handle(method, target)
+                except Exception as e:
+                    logger.error(f"Request {target} failed: {str(e)}")
+                    status, content_type, body = 500, "application/json", {"error": str(e)}
+                await self._respond(writer, status, content_type, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, content_type, body, keep_alive):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        payload = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+
+
+async def serve(registry_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None, pool_size=POOL_SIZE,
+                ready=None, check=False):
+    # Runs until cancelled, or until SIGINT/SIGTERM where the platform supports it.
+    # ready(address) is called once the service is accepting requests. A Unix socket
+    # is made accessible to its owner only.
+    service = IdService(registry_path or os.path.join(os.getcwd(), REGISTRY_DIRNAME), pool_size, check)
+    await service.start()
+    try:
+        if unix_path:
+            if os.path.lexists(unix_path) and not _remove_socket(unix_path):
+                raise ValueError(f"{unix_path} exists and is not a socket")
+            # Bound owner-only from the start; the chmod is for platforms whose sockets ignore the umask
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(service.serve_connection, unix_path, limit=MAX_HEADER_BYTES)
+            finally:
+                os.umask(umask)
+            os.chmod(unix_path, 0o600)
+            address = unix_path
+        else:
+            server = await asyncio.start_server(service.serve_connection, host, port, limit=MAX_HEADER_BYTES)
+            address = "http://{}:{}".format(*server.sockets[0].getsockname()[:2])
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, lambda: stopped.done() or stopped.set_result(None))
+            except (NotImplementedError, RuntimeError):  # Windows, or not the main thread
+                pass
+        async with server:
+            if ready is not None:
+                ready(address)
+            serving = asyncio.ensure_future(server.serve_forever())
+            try:
+                await asyncio.wait([serving, stopped], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                serving.cancel()
+    finally:
+        await service.stop()
+        if unix_path:
+            _remove_socket(unix_path)
+
+
+def _remove_socket(path):
+    # Removes a socket (e.g. left behind by a previous run), never anything else;
+    # True if there is nothing at path any more
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return False
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return True
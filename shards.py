@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent import futures
+from datetime import datetime
+
+from model import WRITERS, SaveError, check_writer_options, writer_suffix
+
+# Splits a very large run into shard files of a fixed number of IDs, written at the
+# same time by a pool of worker processes. Generation itself stays in this process,
+# with the Model's uniqueness check and ID registry, so the shards never share an ID;
+# the workers only format, compress, encrypt and checksum. Everything goes into one
+# new directory together with a manifest:
+#
+#   generated_ids_<timestamp>/
+#       generated_ids_<timestamp>_00000.txt.gz
+#       generated_ids_<timestamp>_00001.txt.gz
+#       ...
+#       manifest.json    format, totals, and each shard's rows, size and SHA-256
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+# Default IDs per shard
+SHARD_SIZE = 10_000_000
+
+# Shards handed to each worker ahead of time; bounds memory to a few packed shards
+# per worker while generation keeps running
+QUEUE_DEPTH = 2
+
+# Read size when checksumming a finished shard
+HASH_BLOCK = 1 << 20
+
+# Set in each worker process by _init_worker
+_worker_options = None
+
+
+def shard_name(prefix, number, file_type, public_keys=None, compression=None):
+    return f"{prefix}_{number:05d}{file_type}{writer_suffix(public_keys, compression)}"
+
+
+def file_digest(path):
+    # (SHA-256 hex digest, size in bytes) of a file as it is on disk
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(HASH_BLOCK):
+            digest.update(block)
+    return digest.hexdigest(), os.path.getsize(path)
+
+
+def _new_directory(dest_path, name):
+    # (name, path) of a directory created for this export; exports started in the
+    # same second get "_2", "_3", ... appended
+    number = 1
+    while True:
+        prefix = name if number == 1 else f"{name}_{number}"
+        directory = os.path.join(dest_path, prefix)
+        try:
+            os.makedirs(directory)
+            return prefix, directory
+        except FileExistsError:
+            number += 1
+
+
+def _init_worker(file_type, check, compression, public_keys):
+    # The writer options arrive once per worker instead of with every shard
+    global _worker_options
+    _worker_options = (file_type, check, compression, public_keys)
+
+
+def _write_shard(path, packed):
+    file_type, check, compression, public_keys = _worker_options
+    writer = WRITERS[file_type](path, public_keys=public_keys, check=check, compression=compression)
+    try:
+        writer.write(packed)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return file_digest(path)
+
+
+def export_shards(model, dest_path, file_type, count, shard_size=SHARD_SIZE, compression=None, workers=None,
+                  public_keys=None, progress=None, cancel_event=None, start_counter=0):
+    # Generates count IDs with model into a new directory under dest_path and returns
+    # (manifest path, manifest). progress(rows_done, count) is called after every finished shard.
+    # On cancel or failure the shards already finished are kept and the manifest is
+    # written with "complete": false; a failure is raised afterwards.
+    check_writer_options(file_type, public_keys, compression)
+    if shard_size < 1:
+        raise ValueError("The shard size must be at least 1")
+    shard_count = -(-count // shard_size)
+    workers = max(1, min(workers or os.cpu_count() or 1, shard_count or 1))
+    started = datetime.now()
+    prefix, directory = _new_directory(dest_path, f"generated_ids_{started:%Y%m%d_%H%M%S}")
+    manifest = {
+        "format": file_type[1:],
+        "compression": compression,
+        "encrypted": bool(public_keys),
+        "check_character": model.check,
+        "total": count,
+        "shard_size": shard_size,
+        "started": started.isoformat(timespec="seconds"),
+        "finished": None,
+        "complete": False,
+        "shards": [],
+    }
+    shards = {}
+    pending = {}
+    error = None
+    rows_done = 0
+
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    try:
+        with futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                         initargs=(file_type, model.check, compression, public_keys)) as executor:
+            next_shard = 0
+            while next_shard < shard_count or pending:
+                stopping = error is not None or (cancel_event is not None and cancel_event.is_set())
+                # Keep the pool fed; the next shard is generated while the workers write
+                while not stopping and next_shard < shard_count and len(pending) < workers * QUEUE_DEPTH:
+                    first_row = next_shard * shard_size
+                    rows = min(shard_size, count - first_row)
+                    name = shard_name(prefix, next_shard, file_type, public_keys, compression)
+                    try:
+                        packed = model.generate_packed(rows, start_counter + first_row)
+                    except Exception as e:
+                        error = e
+                        break
+                    future = executor.submit(_write_shard, os.path.join(directory, name), packed)
+                    pending[future] = {"file": name, "first_row": first_row, "rows": rows}
+                    next_shard += 1
+                if stopping:
+                    next_shard = shard_count  # Nothing more is queued; in-flight shards finish
+                if not pending:
+                    continue
+
+                done, _ = futures.wait(pending, timeout=0.1, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    shard = pending.pop(future)
+                    try:
+                        shard["sha256"], shard["bytes"] = future.result()
+                    except Exception as e:
+                        logger.error(f"Could not write shard {shard['file']}: {str(e)}")
+                        error = error or e
+                        continue
+                    shards[shard["first_row"]] = shard
+                    rows_done += shard["rows"]
+                    if progress is not None:
+                        progress(rows_done, count)
+    finally:
+        # Also after Ctrl-C, so the finished shards are never left undocumented
+        manifest["shards"] = [shards[first_row] for first_row in sorted(shards)]
+        manifest["complete"] = rows_done == count
+        manifest["finished"] = datetime.now().isoformat(timespec="seconds")
+        with open(manifest_path + ".part", 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(manifest_path + ".part", manifest_path)
+    if error is not None:
+        raise SaveError(f"Error writing shards to {directory}: {str(error)}")
+    return manifest_path, manifest
+
+
+def verify_manifest(manifest_path):
+    # Problems found when checking each shard listed in a manifest against the file
+    # next to it; an empty list means every shard is present and unchanged
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    problems = []
+    if not manifest.get("complete"):
+        problems.append(f"{manifest_path}: the export did not complete")
+    for shard in manifest["shards"]:
+        path = os.path.join(directory, shard["file"])
+        if not os.path.isfile(path):
+            problems.append(f"{shard['file']}: missing")
+            continue
+        if os.path.getsize(path) != shard["bytes"]:
+            problems.append(f"{shard['file']}: {os.path.getsize(path)} bytes instead of {shard['bytes']}")
+            continue
+        if file_digest(path)[0] != shard["sha256"]:
+            problems.append(f"{shard['file']}: checksum mismatch")
+    return problems
@@ -6,7 +6,7 @@ from datetime import datetime
 class View(wx.Frame):
     def __init__(self, parent, controller):
         wx.Frame.__init__(self, parent, id=wx.ID_ANY, title=_(u"E-Health ID Generator"),
-                          pos=wx.DefaultPosition, size=wx.Size(500, 470),
+                          pos=wx.DefaultPosition, size=wx.Size(500, 530),
                           style=wx.DEFAULT_FRAME_STYLE & ~(wx.MAXIMIZE_BOX | wx.RESIZE_BORDER) | wx.TAB_TRAVERSAL)
 
         self.controller = controller
@@ -80,12 +80,33 @@ class View(wx.Frame):
         self.type_sizer = wx.BoxSizer(wx.HORIZONTAL)
         self.type_label = wx.StaticText(self.generate_id_panel, wx.ID_ANY, _(u"Save As Type:"), wx.DefaultPosition, wx.DefaultSize, 0)
         self.type_sizer.Add(self.type_label, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
-        file_types = [".csv", ".txt", ".json", ".xlsx"]
+        file_types = [".csv", ".txt", ".json", ".xlsx", ".parquet", ".ehid"]
         self.type_choice = wx.Choice(self.generate_id_panel, wx.ID_ANY, wx.DefaultPosition, wx.DefaultSize, file_types, 0)
         self.type_choice.SetSelection(0)
         self.type_sizer.Add(self.type_choice, 1, wx.ALL, 5)
         self.generate_id_sizer.Add(self.type_sizer, 0, wx.EXPAND | wx.ALL, 5)
 
+        # Uniqueness
+        self.unique_checkbox = wx.CheckBox(self.generate_id_panel, wx.ID_ANY, _(u"Guarantee unique IDs"), wx.DefaultPosition, wx.DefaultSize, 0)
+        self.unique_checkbox.SetToolTip(wx.ToolTip("Never issue an ID twice, within this run or across earlier runs saved to the same destination."))
+        self.unique_checkbox.SetValue(True)
+        self.generate_id_sizer.Add(self.unique_checkbox, 0, wx.ALL, 10)
+
+        # Parallel generation
+        self.parallel_checkbox = wx.CheckBox(self.generate_id_panel, wx.ID_ANY, _(u"Use all CPU cores"), wx.DefaultPosition, wx.DefaultSize, 0)
+        self.parallel_checkbox.SetToolTip(wx.ToolTip("Generate IDs on every core. A seed gives the same IDs on any machine in this mode, but not the same IDs as single-core generation."))
+        self.generate_id_sizer.Add(self.parallel_checkbox, 0, wx.LEFT | wx.RIGHT | wx.BOTTOM, 10)
+
+        # Check character
+        self.check_checkbox = wx.CheckBox(self.generate_id_panel, wx.ID_ANY, _(u"Add a check character"), wx.DefaultPosition, wx.DefaultSize, 0)
+        self.check_checkbox.SetToolTip(wx.ToolTip("Append a 10th character computed from the other nine, so a mistyped ID is detected instead of matching nothing or the wrong patient."))
+        self.generate_id_sizer.Add(self.check_checkbox, 0, wx.LEFT | wx.RIGHT | wx.BOTTOM, 10)
+
+        # Encrypted output
+        self.encrypt_output_checkbox = wx.CheckBox(self.generate_id_panel, wx.ID_ANY, _(u"Encrypt output with Crypt4GH"), wx.DefaultPosition, wx.DefaultSize, 0)
+        self.encrypt_output_checkbox.SetToolTip(wx.ToolTip("Encrypt the IDs for the recipients' public keys while they are written, so no plaintext file is ever saved. Not available for .xlsx."))
+        self.generate_id_sizer.Add(self.encrypt_output_checkbox, 0, wx.LEFT | wx.RIGHT | wx.BOTTOM, 10)
+
         # Generate Button
         self.generate_id_btn = wx.Button(self.generate_id_panel, wx.ID_ANY, _(u"Generate IDs"), wx.DefaultPosition, wx.DefaultSize, 0)
         self.generate_id_sizer.Add(self.generate_id_btn, 0, wx.ALL | wx.ALIGN_CENTER, 5)
@@ -108,6 +129,15 @@ class View(wx.Frame):
         self.select_file_sizer.Add(self.file_picker, 1, wx.ALL, 5)
         self.encrypt_sizer.Add(self.select_file_sizer, 0, wx.EXPAND | wx.ALL, 5)
 
+        # Select Folder (batch mode)
+        self.select_folder_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.select_folder_label = wx.StaticText(self.encrypt_panel, wx.ID_ANY, _(u"Or Folder:"), wx.DefaultPosition, wx.DefaultSize, 0)
+        self.select_folder_sizer.Add(self.select_folder_label, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        self.folder_picker = wx.DirPickerCtrl(self.encrypt_panel, wx.ID_ANY, wx.EmptyString, _(u"Select a folder to process every file in it"), wx.DefaultPosition, wx.DefaultSize, wx.DIRP_DEFAULT_STYLE)
+        self.folder_picker.SetToolTip(wx.ToolTip("Encrypt or decrypt every file in this folder and its subfolders, on all CPU cores. Takes precedence over the selected file."))
+        self.select_folder_sizer.Add(self.folder_picker, 1, wx.ALL, 5)
+        self.encrypt_sizer.Add(self.select_folder_sizer, 0, wx.EXPAND | wx.ALL, 5)
+
         # Select Key
         self.select_key_sizer = wx.BoxSizer(wx.HORIZONTAL)
         self.select_key_label = wx.StaticText(self.encrypt_panel, wx.ID_ANY, _(u"Select Key:"), wx.DefaultPosition, wx.DefaultSize, 0)
@@ -121,7 +151,10 @@ class View(wx.Frame):
         self.radio_encrypt_action = wx.RadioButton(self.encrypt_panel, wx.ID_ANY, _(u"Encrypt"), wx.DefaultPosition, wx.DefaultSize, wx.RB_GROUP)
         self.radio_decrypt_action = wx.RadioButton(self.encrypt_panel, wx.ID_ANY, _(u"Decrypt"), wx.DefaultPosition, wx.DefaultSize, 0)
         self.encrypt_radio_sizer.Add(self.radio_encrypt_action, 0, wx.ALL, 5)
+        self.radio_rekey_action = wx.RadioButton(self.encrypt_panel, wx.ID_ANY, _(u"Re-key"), wx.DefaultPosition, wx.DefaultSize, 0)
+        self.radio_rekey_action.SetToolTip(wx.ToolTip("Replace who can read encrypted files: the selected private key opens them and you choose the new recipients' public keys. Only the file headers are rewritten."))
         self.encrypt_radio_sizer.Add(self.radio_decrypt_action, 0, wx.ALL, 5)
+        self.encrypt_radio_sizer.Add(self.radio_rekey_action, 0, wx.ALL, 5)
         self.encrypt_sizer.Add(self.encrypt_radio_sizer, 0, wx.ALIGN_CENTER | wx.ALL, 5)
 
         # Process Button
@@ -184,14 +217,39 @@ class View(wx.Frame):
     def get_file_type(self):
         return self.type_choice.GetStringSelection()
 
+    def get_unique(self):
+        return self.unique_checkbox.GetValue()
+
+    def get_parallel(self):
+        return self.parallel_checkbox.GetValue()
+
+    def get_check_character(self):
+        return self.check_checkbox.GetValue()
+
+    def get_encrypt_output(self):
+        return self.encrypt_output_checkbox.GetValue()
+
     def get_file_path(self):
         return self.file_picker.GetPath()
 
+    def get_folder_path(self):
+        return self.folder_picker.GetPath()
+
     def get_key_path(self):
         return self.key_picker.GetPath()
 
     def get_encrypt_action(self):
-        return "Encrypt" if self.radio_encrypt_action.GetValue() else "Decrypt"
+        if self.radio_encrypt_action.GetValue():
+            return "Encrypt"
+        return "Re-key" if self.radio_rekey_action.GetValue() else "Decrypt"
+
+    def ask_public_keys(self, message="Select the new recipients' public keys"):
+        # Several recipients can be selected at once; returns [] when cancelled
+        with wx.FileDialog(self, message, wildcard="Public keys (*.pub)|*.pub|All files (*.*)|*.*",
+                           style=wx.FD_OPEN | wx.FD_MULTIPLE | wx.FD_FILE_MUST_EXIST) as dialog:
+            if dialog.ShowModal() != wx.ID_OK:
+                return []
+            return dialog.GetPaths()
 
     def get_key_output_path(self):
         return self.key_output_picker.GetPath()